@@ -7,20 +7,73 @@ INSTALL: sudo apt install python-pyquery python-certifi python3-pyquery
 (c) Nicolas Alt
 """
 
-import requests
-from pyquery import PyQuery as pq
 import argparse
 import re
 import os.path, shutil
 import json
+import urllib.parse
 import datetime
-import isodate
 import subprocess
+import time
+import random
+import email.utils
+import contextlib
+import bisect
+import signal
+import collections
+import threading
+import concurrent.futures
+import queue
+import sqlite3
+import hashlib
+import io
+import struct
+import zlib
+import stat
+import sys
+import importlib
+import importlib.util
 
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-#import urllib3
-#urllib3.disable_warnings()
+
+class LazyModule:
+	"""
+	Placeholder for a module which is only imported on first attribute access, to keep
+	the startup of the command line fast. Thread-safe. After the import, the global
+	alias refers to the module itself. PyQuery is imported directly in loginForm().
+	"""
+	def __init__(self, name, alias):
+		self._name = name
+		self._alias = alias
+		self._lock = threading.Lock()
+
+	def __getattr__(self, attr):
+		with self._lock:
+			module = importlib.import_module(self._name)
+			globals()[self._alias] = module
+		return getattr(module, attr)
+
+def lazyImport(name, alias=None, optional=False):
+	"""
+	Module name, imported on first use, see LazyModule
+	alias    -- Global name of the module in this file (default: name)
+	optional -- Return None if the module is not installed, instead of raising ImportError
+	"""
+	if name in sys.modules:
+		return sys.modules[name]
+	try:
+		spec = importlib.util.find_spec(name)
+	except ImportError:
+		spec = None
+	if spec is None:
+		if optional:
+			return None
+		raise ModuleNotFoundError("No module named '%s'" % (name), name=name)
+	return LazyModule(name, alias or name)
+
+requests = lazyImport('requests')
+isodate = lazyImport('isodate')
+pypdf = lazyImport('pypdf', optional=True)
+Image = lazyImport('PIL.Image', 'Image', optional=True)
 
 
 def enum(*sequential, **named):
@@ -30,116 +83,1534 @@ def enum(*sequential, **named):
     return type('Enum', (), enums)
 
 
-class Dropscan:
+# One parsed entry of the local file index: <date>_<barcode><-tags><_type>.<ext>
+# type is None if the part after the barcode does not follow that scheme
+LocalFile = collections.namedtuple('LocalFile', ['path', 'date', 'barcode', 'tags', 'type', 'ext'])
+
+
+class Mailing:
+	"""
+	One mailing of a list returned by getList(). Date, filenames and status tag are
+	computed once when the mailing is listed. Other fields of the JSON are available
+	with m['key'] / m.get('key'), the JSON itself as m.json.
+	"""
+	__slots__ = ('id', 'barcode', 'status', 'recipient', 'created_at', 'created', 'date', 'stem',
+		'tag', 'scanbox_id', 'names', '_json', '_tag_re')
+	FIELDS = frozenset(['id', 'barcode', 'status', 'recipient', 'created_at', 'scanbox_id'])
+	# Tag in the filename for the status
+	TAGS = { 'forwarded': 'F', 'forward_requested': 'R', 'destroyed': 'D', 'destroy_requested': 'D' }
+	# Filename suffix per Dropscan.TYPE (thumb, envelope, pdf, zip, full)
+	SUFFIXES = ('_thumb.jpg', '_envelope.jpg', '_pdf.pdf', '_zip.pdf', '.pdf')
+
+	def __init__(self, json, scanbox_id=None):
+		self._json = json
+		self._tag_re = None
+		self.id = json['id']
+		self.barcode = json['barcode']
+		self.status = json['status']
+		self.recipient = json.get('recipient', '')
+		self.created_at = json['created_at']
+		self.scanbox_id = json.get('scanbox_id', scanbox_id)
+		self.created = isodate.parse_datetime(self.created_at)
+		self.date = self.created.strftime('%Y-%m-%d')
+		self.stem = self.date + '_' + self.barcode
+		self.tag = self.TAGS.get(self.status, '')
+		self.names = tuple(self.stem + suffix for suffix in self.SUFFIXES)
+
+	@classmethod
+	def of(cls, mailing):
+		"""
+		Mailing for a mailing or its JSON dict
+		"""
+		return mailing if isinstance(mailing, cls) else cls(mailing)
+
+	@property
+	def json(self):
+		return self._json
+
+	def tagPattern(self):
+		"""
+		Regex for <barcode><-tags> in a filename, see Dropscan.writeTag()
+		"""
+		if self._tag_re is None:
+			b = re.escape(self.barcode)
+			self._tag_re = re.compile(".*(" + b + ")(-[A-Z]*)|.*(" + b + ")")
+		return self._tag_re
+
+	def __getitem__(self, key):
+		if key in self.FIELDS:
+			return getattr(self, key)
+		return self._json[key]
+
+	def get(self, key, default=None):
+		if key in self.FIELDS:
+			return getattr(self, key)
+		return self._json.get(key, default)
+
+	def __contains__(self, key):
+		return key in self.FIELDS or key in self._json
+
+	def __repr__(self):
+		return 'Mailing(%s, %s, %s)' % (self.id, self.barcode, self.status)
+
+
+def jpegInfo(data):
+	"""
+	Get (width, height, components, dpi) of a JPEG from its SOF and JFIF headers.
+	dpi is 72 if the file has no density information.
+	"""
+	if data[:2] != b'\xff\xd8':
+		raise ValueError("Not a JPEG file")
+	pos = 2
+	dpi = 72
+	while pos + 4 <= len(data):
+		if data[pos] != 0xFF:
+			raise ValueError("Invalid JPEG marker")
+		marker = data[pos + 1]
+		if marker == 0xFF:
+			pos += 1
+			continue
+		length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+		seg = data[pos + 4:pos + 2 + length]
+		if marker == 0xE0 and seg[:5] == b'JFIF\x00':
+			units, xdens = seg[7], struct.unpack('>H', seg[8:10])[0]
+			if units == 1 and xdens > 0: dpi = xdens
+			elif units == 2 and xdens > 0: dpi = xdens * 2.54
+		elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+			height, width = struct.unpack('>HH', seg[1:5])
+			return (width, height, seg[5], dpi)
+		pos += 2 + length
+	raise ValueError("No JPEG frame header found")
+
+
+def jpegToPdf(data):
+	"""
+	Wrap JPEG data into a single-page PDF. The image is embedded without re-encoding,
+	the page size follows the image resolution (like ImageMagick convert).
+	"""
+	(width, height, comps, dpi) = jpegInfo(data)
+	colorspace = { 1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK' }[comps]
+	decode = ' /Decode [1 0 1 0 1 0 1 0]' if comps == 4 else ''
+	w = width * 72.0 / dpi
+	h = height * 72.0 / dpi
+	content = ('q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q' % (w, h)).encode()
+	objs = [
+		b'<< /Type /Catalog /Pages 2 0 R >>',
+		b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+		('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>' % (w, h)).encode(),
+		('<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode%s /Length %d >>\nstream\n' %
+			(width, height, colorspace, decode, len(data))).encode() + data + b'\nendstream',
+		('<< /Length %d >>\nstream\n' % (len(content))).encode() + content + b'\nendstream',
+	]
+	out = io.BytesIO()
+	out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+	offsets = []
+	for (i, o) in enumerate(objs):
+		offsets.append(out.tell())
+		out.write(('%d 0 obj\n' % (i + 1)).encode() + o + b'\nendobj\n')
+	xref = out.tell()
+	out.write(('xref\n0 %d\n0000000000 65535 f \n' % (len(objs) + 1)).encode())
+	for off in offsets:
+		out.write(('%010d 00000 n \n' % (off)).encode())
+	out.write(('trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objs) + 1, xref)).encode())
+	return out.getvalue()
+
+
+def combinePdf(file_envelope, file_pdf, file_full):
+	"""
+	Write file_pdf with the envelope JPEG appended as last page to file_full (atomically)
+	"""
+	tmp = file_full + '.part'
+	try:
+		with open(file_envelope, 'rb') as f:
+			env_pdf = jpegToPdf(f.read())
+		writer = pypdf.PdfWriter()
+		writer.append(file_pdf)
+		writer.append(io.BytesIO(env_pdf))
+		with open(tmp, 'wb') as f:
+			writer.write(f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, file_full)
+	finally:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+
+
+def envelopeFromPdf(file_full):
+	"""
+	JPEG data of the envelope page (last page) of a combined PDF, or None if it is not
+	embedded as JPEG (e.g. combined with convert)
+	"""
+	page = pypdf.PdfReader(file_full).pages[-1]
+	for img in page.images:
+		if img.name.lower().endswith('.jpg'):
+			return img.data
+	return None
+
+
+def makeThumb(source, file_thumb, size):
+	"""
+	Write a JPEG thumbnail of an envelope to file_thumb (atomically). The JPEG is decoded
+	in draft mode, i.e. downscaled by the decoder in the DCT domain (1/2 .. 1/8).
+	source  -- JPEG data, or the path of an envelope JPG or combined PDF
+	Returns file_thumb, or None if there is no envelope JPEG
+	"""
+	if isinstance(source, str):
+		if source.endswith('.pdf'):
+			source = envelopeFromPdf(source)
+			if source is None:
+				return None
+		else:
+			with open(source, 'rb') as f:
+				source = f.read()
+	img = Image.open(io.BytesIO(source))
+	img.draft('RGB', size)
+	img.thumbnail(size)
+	tmp = file_thumb + '.part'
+	try:
+		img.convert('RGB').save(tmp, 'JPEG', quality=80)
+		os.replace(tmp, file_thumb)
+	finally:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+	return file_thumb
+
+
+class StreamReader:
+	"""
+	Exact reads from a read(n) function (e.g. of an HTTP response), with push back
+	"""
+	def __init__(self, read):
+		self.readRaw = read
+		self.buf = b''
+
+	def read(self, n):
+		while len(self.buf) < n:
+			data = self.readRaw(max(n - len(self.buf), Dropscan.CHUNK_SIZE))
+			if not data:
+				break
+			self.buf += data
+		(data, self.buf) = (self.buf[:n], self.buf[n:])
+		return data
+
+	def readExact(self, n):
+		data = self.read(n)
+		if len(data) != n:
+			raise ValueError("ZIP archive truncated")
+		return data
+
+	def unread(self, data):
+		self.buf = data + self.buf
+
+
+def unzipStream(read, target, chunk_size=64 * 1024):
+	"""
+	Extract a ZIP archive while reading it sequentially, e.g. from an HTTP response,
+	using the local file headers (the central directory at the end is not needed).
+	Supports stored and deflated entries; entries are CRC checked and written atomically.
+	read    -- Function read(n) returning up to n bytes, b'' at the end
+	target  -- Function target(name) returning the path for an entry, or None to skip it
+	Returns list of (name, path, sha256) of the extracted entries
+	"""
+	stream = StreamReader(read)
+	files = []
+	while stream.read(4) == b'PK\x03\x04':
+		(version, flags, method, time_, date_, crc, csize, usize, nlen, xlen) = \
+			struct.unpack('<HHHHHIIIHH', stream.readExact(26))
+		name = stream.readExact(nlen).decode('utf-8' if flags & 0x800 else 'cp437')
+		stream.readExact(xlen)
+		descriptor = flags & 0x08
+		if flags & 0x01 or method not in (0, 8) or (descriptor and method == 0) or csize == 0xFFFFFFFF:
+			raise ValueError("Unsupported ZIP entry: " + name)
+		path = target(name)
+		tmp = path + '.part' if path else None
+		out = open(tmp, 'wb') if tmp else None
+		h = hashlib.sha256()
+		crc_data = 0
+		inflate = zlib.decompressobj(-15) if method == 8 else None
+		remaining = None if descriptor else csize
+		try:
+			while remaining is None or remaining > 0:
+				data = stream.read(chunk_size if remaining is None else min(chunk_size, remaining))
+				if not data:
+					raise ValueError("ZIP archive truncated")
+				if remaining is not None:
+					remaining -= len(data)
+				if inflate is not None:
+					data = inflate.decompress(data)
+				crc_data = zlib.crc32(data, crc_data)
+				if out is not None:
+					out.write(data)
+					h.update(data)
+				if inflate is not None and inflate.eof:
+					stream.unread(inflate.unused_data)
+					break
+			if descriptor:
+				sig = stream.readExact(4)
+				crc = struct.unpack('<I', stream.readExact(4) if sig == b'PK\x07\x08' else sig)[0]
+				stream.readExact(8)
+			if crc_data != crc:
+				raise ValueError("CRC error in ZIP entry: " + name)
+			if out is not None:
+				out.flush()
+				os.fsync(out.fileno())
+				out.close()
+				out = None
+				os.replace(tmp, path)
+				files.append((name, path, h.hexdigest()))
+		finally:
+			if out is not None:
+				out.close()
+				os.remove(tmp)
+	return files
+
+
+_CircuitOpenError = None
+
+def circuitOpenError():
+	"""
+	Exception class raised while the circuit breaker is open. It is derived from
+	requests.exceptions.RequestException, so it is created on first use.
+	"""
+	global _CircuitOpenError
+	if _CircuitOpenError is None:
+		_CircuitOpenError = type('CircuitOpenError', (requests.exceptions.RequestException,), { '__module__': __name__ })
+	return _CircuitOpenError
+
+def __getattr__(name):
+	# from dropscan import CircuitOpenError
+	if name == 'CircuitOpenError':
+		return circuitOpenError()
+	raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+class AuthError(Exception):
+	"""
+	Login failed, or a request was still rejected after logging in again
+	"""
+	pass
+
+
+class RateLimiter:
+	"""
+	Token bucket shared by all threads: at most rate requests (or bytes) per second (0: no limit)
+	"""
+	def __init__(self, rate=0):
+		self.rate = rate
+		self.next = 0.0
+		self.lock = threading.Lock()
+
+	def reserve(self, n=1):
+		"""
+		Reserve a slot for n requests (or bytes). Returns seconds to wait before sending them.
+		"""
+		if self.rate <= 0:
+			return 0.0
+		with self.lock:
+			now = time.monotonic()
+			slot = max(now, self.next)
+			self.next = slot + float(n) / self.rate
+			return slot - now
+
+
+class CircuitBreaker:
+	"""
+	Stops requests for cooldown seconds after threshold consecutive failures.
+	After the cooldown, requests are let through again; the next failure reopens it.
+	"""
+	def __init__(self, threshold=10, cooldown=60):
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.failures = 0
+		self.open_until = 0.0
+		self.lock = threading.Lock()
+
+	def check(self):
+		if self.threshold > 0 and time.monotonic() < self.open_until:
+			raise circuitOpenError()("Too many failed requests, paused for %d s" % (self.open_until - time.monotonic()))
+
+	def success(self):
+		with self.lock:
+			self.failures = 0
+
+	def failure(self):
+		with self.lock:
+			self.failures += 1
+			if self.threshold > 0 and self.failures >= self.threshold:
+				self.open_until = time.monotonic() + self.cooldown
+				self.failures = self.threshold - 1
+
+
+class Metrics:
+	"""
+	Timers, counters and HTTP request statistics of a run. Thread-safe.
+	Hooks added with addHook(fn) are called for each event as
+	fn(kind, name, value, labels), with kind one of 'timer', 'count', 'gauge', 'request',
+	'bytes' (data of a streamed response, value is the number of bytes).
+	"""
+	BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.timers = {}
+		self.counters = {}
+		self.gauges = {}
+		self.requests = {}
+		self.hooks = []
+
+	def addHook(self, fn):
+		self.hooks.append(fn)
+
+	def emit(self, kind, name, value, labels={}):
+		for fn in self.hooks:
+			fn(kind, name, value, labels)
+
+	@contextlib.contextmanager
+	def timer(self, name):
+		"""
+		Context manager that adds the elapsed time to timer name
+		"""
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			self.addTime(name, time.monotonic() - start)
+
+	def addTime(self, name, seconds):
+		with self.lock:
+			t = self.timers.setdefault(name, { 'count': 0, 'seconds': 0.0, 'max': 0.0 })
+			t['count'] += 1
+			t['seconds'] += seconds
+			t['max'] = max(t['max'], seconds)
+		self.emit('timer', name, seconds)
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+		self.emit('count', name, n)
+
+	def gauge(self, name, value):
+		with self.lock:
+			self.gauges[name] = value
+		self.emit('gauge', name, value)
+
+	def request(self, endpoint, status, seconds, nbytes=0):
+		"""
+		Record one HTTP request by endpoint (or file type for downloads)
+		"""
+		with self.lock:
+			e = self.requests.setdefault(endpoint, { 'count': 0, 'errors': 0, 'bytes': 0,
+				'seconds': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1) })
+			e['count'] += 1
+			if status is None or status >= 400: e['errors'] += 1
+			e['bytes'] += nbytes
+			e['seconds'] += seconds
+			e['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+		self.emit('request', endpoint, seconds, { 'status': status, 'bytes': nbytes })
+
+	def addBytes(self, endpoint, nbytes):
+		"""
+		Add nbytes received of a streamed response to the request statistics of endpoint
+		"""
+		with self.lock:
+			if endpoint in self.requests:
+				self.requests[endpoint]['bytes'] += nbytes
+		self.emit('bytes', endpoint, nbytes)
+
+	def toJSON(self):
+		with self.lock:
+			return json.dumps({ 'timers': self.timers, 'counters': self.counters, 'gauges': self.gauges,
+				'requests': self.requests, 'buckets': self.BUCKETS }, indent=2, sort_keys=True)
+
+	def toPrometheus(self, prefix='dropscan'):
+		"""
+		Metrics in the Prometheus text format, e.g. for the node exporter textfile collector
+		"""
+		lines = []
+		def family(name, type, samples):
+			# All samples of a metric family follow its TYPE line
+			if len(samples) > 0:
+				lines.append('# TYPE %s_%s %s' % (prefix, name, type))
+				lines.extend(samples)
+		with self.lock:
+			timers = sorted(self.timers.items())
+			family('phase_seconds_total', 'counter', [ '%s_phase_seconds_total{phase="%s"} %f' % (prefix, name, t['seconds']) for (name, t) in timers ])
+			family('phase_calls_total', 'counter', [ '%s_phase_calls_total{phase="%s"} %d' % (prefix, name, t['count']) for (name, t) in timers ])
+			for (name, v) in sorted(self.counters.items()):
+				family(name + '_total', 'counter', [ '%s_%s_total %d' % (prefix, name, v) ])
+			for (name, v) in sorted(self.gauges.items()):
+				family(name, 'gauge', [ '%s_%s %s' % (prefix, name, v) ])
+			endpoints = sorted(self.requests.items())
+			family('http_request_errors_total', 'counter', [ '%s_http_request_errors_total{endpoint="%s"} %d' % (prefix, ep, e['errors']) for (ep, e) in endpoints ])
+			family('http_response_bytes_total', 'counter', [ '%s_http_response_bytes_total{endpoint="%s"} %d' % (prefix, ep, e['bytes']) for (ep, e) in endpoints ])
+			samples = []
+			for (ep, e) in endpoints:
+				cum = 0
+				for (le, n) in zip([ str(b) for b in self.BUCKETS ] + ['+Inf'], e['buckets']):
+					cum += n
+					samples.append('%s_http_request_seconds_bucket{endpoint="%s",le="%s"} %d' % (prefix, ep, le, cum))
+				samples.append('%s_http_request_seconds_sum{endpoint="%s"} %f' % (prefix, ep, e['seconds']))
+				samples.append('%s_http_request_seconds_count{endpoint="%s"} %d' % (prefix, ep, e['count']))
+			family('http_request_seconds', 'histogram', samples)
+		return "\n".join(lines) + "\n"
+
+	def writePrometheus(self, filename):
+		"""
+		Write the textfile atomically, so a collector never reads a partial file
+		"""
+		with open(filename + '.part', 'w') as f:
+			f.write(self.toPrometheus())
+		os.replace(filename + '.part', filename)
+
+
+class DropscanClient:
+	"""
+	Parts of the Dropscan client that do not send requests: filenames, URLs, scanbox
+	selection, login form, the retry policy and resuming downloads. Shared by Dropscan and AsyncDropscan
+	(dropscan_async.py), so that both behave the same.
+	"""
 	FILTER = enum('received', 'scanned', 'forwarded', 'destroyed')
 	TYPE   = enum('thumb', 'envelope', 'pdf', 'zip', 'full')
-	SYNC_DB = "dropscan.sync"
+	# Lists sorted by the time their mailings entered the status, so that incremental
+	# listings can stop at a watermark. Other statuses are sorted by created_at, where
+	# a mailing changing its status lands behind newer ones; they are not incremental.
+	SORTING = { 'received': 'created_at', 'scanned': 'scanned_at' }
+	# Bulk download: ZIP archive of the envelopes and PDFs of several mailings, see zipUrl().
+	# Experimental: secure.dropscan.de has no such endpoint, only dropscan_mock.py implements it.
+	ZIP_PATH = '/services/mailings/zip'
+	PAGE_SIZE = 100
+	BASE_URL = 'https://secure.dropscan.de'
 	verbose = 0
 	user = ""
 	password = ""
-	session = None
 	scanbox = None;
+	scanbox_select = None
+	login_count = 0
 	list_count = 20
-	folders = ['.']
-	syncdb = []
-	local_folders_cache = None
-	local_files_cache = None
+	CHUNK_SIZE = 64 * 1024
+	MAX_RETRY_AFTER = 300
 
 	def __init__(self, user, password, verbose=0):
 		self.user = user
 		self.password = password
 		self.verbose = verbose
-		self.session = requests.Session()
+		self.scanboxes = {}
+		self.scanbox_ids = []
+		self.metrics = Metrics()
+		self.setRetry()
+
+	def setBaseUrl(self, url):
+		"""
+		Use another server than secure.dropscan.de, e.g. a local test server
+		"""
+		self.BASE_URL = url.rstrip('/')
+
+	def setListCount(self, count):
+		"""
+		Set number of items to request from dropscan; their default is 20
+		"""
+		self.list_count = count
+
+	def loginForm(self, content):
+		"""
+		Get the auth token from the login page and return the login form data
+		"""
+		from pyquery import PyQuery as pq
+		d = pq(content)
+		auth_token = d('meta[name="csrf-token"]').attr("content")
+		if auth_token is None: print("Error: No auth token")
+		if self.verbose >= 3: print ("Auth token: ", auth_token)
+		return { 'user[email]': self.user, 'user[password]': self.password, 'user[remember_me]': 0,
+			'authenticity_token': auth_token}
+
+	def checkLogin(self, url):
+		"""
+		Raise if the final URL after posting the login form is not the mailings page
+		"""
+		# Login results in a 302 forward to the scanbox URL.
+		m = re.search('.*/mailings$', str(url))
+		if m is None:
+			raise AuthError("Login error.");
+
+	def setRetry(self, retries=4, backoff=1.0, rate=0, breaker=10, cooldown=60):
+		"""
+		Configure the request layer
+		retries   -- Retries of a request on connection errors, 429 and 5xx
+		backoff   -- Base delay in seconds, doubled on each retry (with jitter)
+		rate      -- Maximum requests per second over all threads, 0 for no limit
+		breaker   -- Consecutive failed requests after which no request is sent for cooldown seconds
+		"""
+		self.retries = retries
+		self.backoff = backoff
+		self.rate_limiter = RateLimiter(rate)
+		self.breaker = CircuitBreaker(breaker, cooldown)
+
+	def endpointName(self, url):
+		"""
+		Short endpoint name of an URL for metrics, e.g. mailings, pdf, request_forward
+		"""
+		path = urllib.parse.urlparse(url).path
+		m = re.match(r'^/services/(\w+)(?:/[^/]+/(\w+))?', path)
+		if m:
+			return m.group(2) or m.group(1)
+		return path.strip('/').split('/')[0] or 'root'
+
+	def isRetryable(self, method, status):
+		if method.lower() == 'post':
+			return status in (429, 503)
+		return status == 429 or status >= 500
+
+	def retryDelay(self, attempt, retry_after=None):
+		"""
+		Delay before retry number attempt+1: Retry-After (seconds or HTTP date) if given,
+		capped at MAX_RETRY_AFTER, else full jitter over an exponential backoff, capped at 60 s
+		"""
+		if retry_after:
+			try:
+				return min(self.MAX_RETRY_AFTER, max(0.0, float(retry_after)))
+			except ValueError:
+				try:
+					date = email.utils.parsedate_to_datetime(retry_after)
+					delay = (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+					return min(self.MAX_RETRY_AFTER, max(0.0, delay))
+				except (TypeError, ValueError):
+					pass
+		return random.uniform(0, min(60.0, self.backoff * 2 ** attempt))
+
+	def selectScanboxes(self, ids):
+		"""
+		Restrict listing and sync to the given scanbox IDs (None: all scanboxes of the account)
+		"""
+		self.scanbox_select = [ str(i) for i in ids ] if ids else None
+
+	def setScanboxes(self, scanboxes):
+		"""
+		Set self.scanboxes (id -> JSON) and self.scanbox_ids from the scanboxes JSON,
+		honoring selectScanboxes(). self.scanbox is the first selected scanbox.
+		"""
+		self.scanboxes = { str(sb['id']): sb for sb in scanboxes }
+		ids = list(self.scanboxes)
+		if self.scanbox_select:
+			missing = [ i for i in self.scanbox_select if i not in self.scanboxes ]
+			if missing:
+				raise Exception("Unknown scanbox: " + ','.join(missing))
+			ids = self.scanbox_select
+		self.scanbox_ids = ids
+		self.scanbox = ids[0]
+		if self.verbose >= 2:
+			for i in ids:
+				print("Scanbox ID:", i, "Receipients:", ','.join([r['name'] for r in self.scanboxes[i].get('recipients', [])]))
+
+	def listUrl(self, filter_str, page_size, page, scanbox=None):
+		"""
+		URL of one page of the mailing list
+		"""
+		# https://secure.dropscan.de/services/mailings?max_per_page=100&scanbox_ids=1834&sort_dir=desc&sorting=scanned_at&statuses=scanned
+		return self.BASE_URL + '/services/mailings?sort_dir=desc&sorting=' + self.SORTING.get(filter_str, 'created_at') + '&' + \
+			"scanbox_ids=" + str(scanbox or self.scanbox) + '&statuses=' + filter_str + \
+			'&max_per_page=' + str(page_size) + '&page=' + str(page)
+
+	def filterBatches(self, batches, only_unsent=True):
+		"""
+		Add is_sent flag, filter and sort batches JSON
+		"""
+		batches = [ b.update({'is_sent': 'sent_at' in b and b['sent_at'] is not None }) or b for b in batches ]
+		batches = [ b for b in batches if not b['is_sent'] or not only_unsent ]
+		batches.sort(key=lambda e: e['requested_for'])
+		return batches
+
+	def batchesUrl(self):
+		return self.BASE_URL + '/services/forwarding_batches?max_per_page=100&page=0'
+
+	def isInBatch(self, mailing, batch):
+		"""
+		Check if mailing is already in the given or any other forwarding batch
+		"""
+		ids = [ m['id'] if isinstance(m, dict) else m for m in batch['mailings'] ]
+		if mailing['id'] in ids or mailing.get('forwarding_batch_id') is not None:
+			if self.verbose >= 1: print ("Mailing", mailing['id'], "already in batch")
+			return True
+		return False
+
+	def forwardUrl(self, mailing):
+		return self.BASE_URL + '/services/mailings/%s/request_forward' % (mailing['id'])
+
+	def mailingUrl(self, mailing, type):
+		"""
+		URL of thumb, envelope or PDF of a mailing. None if there is nothing to download.
+		"""
+		m = mailing
+		#url_json ='https://secure.dropscan.de/scanboxes/' + \
+		#		self.scanbox + '/mailings/' + mailing['slug'] + '.json'
+		#r = self.session.get(url_json)
+		#m = r.json()
+
+		if type == self.TYPE.thumb:
+			url = m['envelope_thumbnail_url']
+		elif type == self.TYPE.envelope:
+			# The URL of the large envelope is *.jpg instead of *.small.jpg
+			# Otherwise, this would have to be extracted from /scanboxes/*/mailings/*
+			#OLD url = re.sub(r'^(.*)\.small\.(.*)$', r'\1.\2', m['envelope_thumbnail_url']);
+			url = m['envelope_url']
+		elif type == self.TYPE.pdf:
+			if not 'scanned_at' in m or not m['scanned_at']:
+				if self.verbose >=2: print ("Mailing %s not (yet) scanned" % (m['barcode']))
+				return None
+			url = self.BASE_URL + "/services/mailings/" + m['id'] + "/pdf?src="
+			#OLD url = 'https://secure.dropscan.de/scanboxes/' + self.scanbox + '/mailings/' + m['slug'] + '/download_pdf'
+		elif type == self.TYPE.zip:
+			url = self.zipUrl([m])
+		return url
+
+	def zipUrl(self, mailings):
+		"""
+		URL of a ZIP archive with envelopes and PDFs of the given mailings. The archive has
+		the entries <id>_envelope.jpg and <id>.pdf (only for scanned mailings).
+		"""
+		return self.BASE_URL + self.ZIP_PATH + '?mailing_ids=' + ','.join([ str(m['id']) for m in mailings ])
+
+	def mailingTarget(self, mailing, filename):
+		"""
+		Target path for a download - sort by scanbox and receipient first name, using the
+		first existing folder of: <scanbox>/<recipient>, <scanbox>, <recipient>.
+		<scanbox> is the name or the ID of the mailing's scanbox.
+		"""
+		if len(filename) == 0:
+			return filename
+		rec = mailing['recipient'].split(" ")[0]
+		folders = []
+		sb = mailing.get('scanbox_id')
+		if sb is not None:
+			for name in [ self.scanboxes.get(str(sb), {}).get('name'), str(sb) ]:
+				if name:
+					folders += [ name + os.sep + rec, name ]
+		folders.append(rec)
+		for folder in folders:
+			if os.path.isdir(folder):
+				return folder + os.sep + filename
+		if self.verbose >= 2:
+			print('Sorting by receipient: Folder "%s" not found' % (rec))
+		return filename
+
+	def resumeAction(self, url, status, content_range, offset):
+		"""
+		How to continue a download to <filename>.part (offset bytes long, requested with
+		a Range header if offset > 0), by the HTTP status and Content-Range of the response.
+		A 206 response is only appended if it starts exactly at the end of .part.
+		Returns: 'write' (from the start), 'append' (at offset), 'restart' (remove .part
+		and request again) or None (error)
+		"""
+		if status == 416 and offset > 0:
+			# Range not satisfiable: .part is stale, start over
+			return 'restart'
+		if status == 200:
+			return 'write'
+		if status != 206:
+			if self.verbose >= 2:
+				print("Invalid HTTP status code", status, "on URL", url)
+			return None
+		rng = re.match(r'bytes (\d+)-', content_range or '')
+		if rng is not None and int(rng.group(1)) == offset:
+			return 'append'
+		if self.verbose >= 2: print ("Unexpected Content-Range on URL", url, content_range)
+		return 'restart' if offset > 0 else None
+
+
+class Dropscan(DropscanClient):
+	SYNC_DB = "dropscan.sync"
+	SYNC_SQLITE = "dropscan.sqlite"
+	SYNC_BATCH = 50
+	WATERMARK_DB = "dropscan.watermark"
+	# Mailings per ZIP archive, see prefetchZip()
+	ZIP_BATCH = 100
+	SNAPSHOT_DB = "dropscan.snapshot"
+	session = None
+	session_cache = None
+	jobs = 1
+	combine_backend = 'auto'
+	tools_checked = False
+	postproc_jobs = 1
+	postproc_timeout = None
+	combine_pool = None
+	post_pool = None
+	has_script_post = None
+	synced_mailings = None
+	thumbs_local = True
+	zip_download = False
+	THUMB_SIZE = (320, 320)
+	script_post = os.path.dirname(os.path.realpath(__file__)) + '/postproc.sh'
+	folders = ['.']
+	syncdb_conn = None
+	statuses = None
+	batches_cache = None
+	full_listing_at = None
+	local_folders_cache = None
+	local_files_cache = None
+	local_index = None
+	snapshot = None
+	# Filename parsing for the local file index
+	RE_TOKEN = re.compile(r'[-_\. ]([^-_\. ]+)')
+	RE_DATE  = re.compile(r'^(\d{4}-\d{2}-\d{2})')
+	RE_TAIL  = re.compile(r'([-A-Z]*)(?:_(thumb|envelope|pdf))?\.([^.]+)$')
+
+	def __init__(self, user, password, verbose=0):
+		super().__init__(user, password, verbose)
+		self._session = None
+		self.syncdb_lock = threading.Lock()
+		self.snapshot_lock = threading.Lock()
+		self.login_lock = threading.Lock()
+		self.stop_event = threading.Event()
+		self.http_cache = {}
+		self.failed_mailings = []
+		self.failed_ids = set()
+		self.bandwidth = RateLimiter(0)
+		self.syncdb = set()
+		self.syncdb_pending = []
+		self.file_hashes = {}
+		self.prefetched = {}
+		self.watermarks = {}
+		self.watermarks_new = {}
+		self.sync_errors = 0
+
+	def openSyncDB(self):
+		"""
+		Open the SQLite sync database, creating it if needed. An existing
+		plain text dropscan.sync is imported on creation.
+		"""
+		if self.syncdb_conn is not None:
+			return self.syncdb_conn
+		create = not os.path.exists(self.SYNC_SQLITE)
+		conn = sqlite3.connect(self.SYNC_SQLITE, check_same_thread=False)
+		conn.execute("""CREATE TABLE IF NOT EXISTS files (
+			name TEXT PRIMARY KEY, barcode TEXT, type TEXT, size INTEGER, sha256 TEXT,
+			status TEXT, downloaded_at TEXT, path TEXT, mtime REAL)""")
+		# Databases before the integrity check lack path and mtime
+		cols = [ r[1] for r in conn.execute("PRAGMA table_info(files)") ]
+		for (col, coltype) in [ ('path', 'TEXT'), ('mtime', 'REAL') ]:
+			if col not in cols:
+				conn.execute("ALTER TABLE files ADD COLUMN %s %s" % (col, coltype))
+		conn.execute("CREATE INDEX IF NOT EXISTS files_barcode ON files (barcode)")
+		conn.execute("""CREATE TABLE IF NOT EXISTS mailings (
+			id TEXT PRIMARY KEY, barcode TEXT, status TEXT, seen_at TEXT)""")
+		if create and os.path.exists(self.SYNC_DB):
+			rows = []
+			with open(self.SYNC_DB) as f:
+				for line in f:
+					fields = line.rstrip("\n").split("\t")
+					if not fields[0]: continue
+					(barcode, type) = self.parseSyncName(fields[0])
+					rows.append((fields[0], barcode, type, fields[1] if len(fields) > 1 else None))
+			conn.executemany("INSERT OR IGNORE INTO files (name, barcode, type, downloaded_at) VALUES (?,?,?,?)", rows)
+			if self.verbose >= 1: print ("Imported", len(rows), "entries from", self.SYNC_DB)
+		conn.commit()
+		self.syncdb_conn = conn
+		return conn
+
+	def parseSyncName(self, name):
+		"""
+		Get (barcode, type) from a filename created by localFileMailing()
+		"""
+		m = re.match(r'^\d{4}-\d{2}-\d{2}_([^-_\. ]+)' + self.RE_TAIL.pattern, name)
+		if m is None:
+			return (None, None)
+		return (m.group(1), m.group(3) or self.TYPE.reverse_mapping[self.TYPE.full])
 
 	def readSyncDB(self):
 		"""
 		Read "database" of local files
 		"""
-		if os.path.exists(self.SYNC_DB):
-			with open(self.SYNC_DB) as f:
-			    files_local = f.readlines()
-		else:
-			files_local = []
-		self.syncdb = [ i.split("\t")[0] for i in files_local ]
+		with self.syncdb_lock:
+			conn = self.openSyncDB()
+			self.syncdb = set(r[0] for r in conn.execute("SELECT name FROM files"))
+
+	def writeSyncDB(self, name, mailing=None, path=None):
+		"""
+		Record a downloaded or combined file. Rows are written in batches, see flushSyncDB().
+		name     -- Original filename, as created by localFileMailing()
+		mailing  -- Mailing struct, to record its status
+		path     -- Local file, to record path, size, mtime and SHA-256. The hash
+		            computed by downloadFile() while streaming is used, if available.
+		"""
+		(barcode, type) = self.parseSyncName(name)
+		size = sha256 = mtime = None
+		if path is not None and os.path.isfile(path):
+			st = os.stat(path)
+			(size, mtime) = (st.st_size, st.st_mtime)
+			sha256 = self.file_hashes.pop(path, None) or self.hashFile(path)
+			path = os.path.normpath(path)
+		status = mailing['status'] if mailing is not None else None
+		if mailing is not None: barcode = mailing['barcode']
+		with self.syncdb_lock:
+			self.syncdb.add(name)
+			self.syncdb_pending.append((name, barcode, type, size, sha256, status,
+				datetime.datetime.now().isoformat(), path, mtime))
+			if len(self.syncdb_pending) >= self.SYNC_BATCH:
+				self.flushSyncDB(locked=True)
+
+	def readStatusDB(self):
+		"""
+		Read the last synced status of all mailings, see statusDelta()
+		"""
+		with self.syncdb_lock:
+			conn = self.openSyncDB()
+			self.statuses = dict(conn.execute("SELECT id, status FROM mailings"))
+
+	def statusDelta(self, mailings):
+		"""
+		Mailings that are new or whose status changed since they were last synced.
+		All mailings, if the status database was not read.
+		"""
+		changed = list(self.iterDelta(mailings))
+		if self.verbose >= 2: print ("%d mailing(s) new or changed" % (len(changed)))
+		return changed
+
+	def iterDelta(self, mailings):
+		"""
+		Iterator version of statusDelta(), e.g. for iterLists()
+		"""
+		for m in mailings:
+			if self.statuses is None or self.statuses.get(m['id']) != m['status']:
+				yield m
+			else:
+				self.metrics.count('mailings_unchanged')
+
+	def writeStatusDB(self, mailings):
+		"""
+		Record the status of successfully synced mailings
+		"""
+		now = datetime.datetime.now().isoformat()
+		rows = [ (m['id'], m['barcode'], m['status'], now) for m in mailings ]
+		with self.syncdb_lock:
+			if self.statuses is not None:
+				self.statuses.update((m['id'], m['status']) for m in mailings)
+			conn = self.openSyncDB()
+			with conn:
+				conn.executemany("INSERT OR REPLACE INTO mailings VALUES (?,?,?,?)", rows)
+
+	def moveSyncDB(self, path, path_new):
+		"""
+		Update the recorded path of a renamed file
+		"""
+		with self.syncdb_lock:
+			self.flushSyncDB(locked=True)
+			conn = self.openSyncDB()
+			with conn:
+				conn.execute("UPDATE files SET path = ? WHERE path = ?",
+					(os.path.normpath(path_new), os.path.normpath(path)))
+
+	def flushSyncDB(self, locked=False):
+		"""
+		Write pending rows of the sync database in one transaction
+		"""
+		if not locked:
+			with self.syncdb_lock:
+				return self.flushSyncDB(locked=True)
+		if len(self.syncdb_pending) == 0:
+			return
+		conn = self.openSyncDB()
+		with conn:
+			conn.executemany("""INSERT OR REPLACE INTO files
+				(name, barcode, type, size, sha256, status, downloaded_at, path, mtime)
+				VALUES (?,?,?,?,?,?,?,?,?)""", self.syncdb_pending)
+		self.syncdb_pending = []
+
+	def querySyncDB(self, pattern):
+		"""
+		Rows of the sync database for a barcode or filename pattern (SQL LIKE)
+		"""
+		self.flushSyncDB()
+		conn = self.openSyncDB()
+		cur = conn.execute("SELECT * FROM files WHERE barcode = ? OR name LIKE ? ORDER BY name",
+			(pattern, pattern))
+		cols = [ c[0] for c in cur.description ]
+		return [ dict(zip(cols, r)) for r in cur ]
+
+	def compactSyncDB(self):
+		"""
+		Reclaim space of the sync database
+		"""
+		self.flushSyncDB()
+		conn = self.openSyncDB()
+		conn.execute("VACUUM")
+
+	@staticmethod
+	def hashFile(path, h=None):
+		"""
+		SHA-256 of a file. Returns the hex digest, or the updated hash object h, if given.
+		"""
+		digest = h is None
+		h = h or hashlib.sha256()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(Dropscan.CHUNK_SIZE), b''):
+				h.update(chunk)
+		return h.hexdigest() if digest else h
+
+	def syncRows(self):
+		"""
+		All rows of the sync database, as dicts
+		"""
+		self.flushSyncDB()
+		cur = self.openSyncDB().execute("SELECT * FROM files ORDER BY name")
+		cols = [ c[0] for c in cur.description ]
+		return [ dict(zip(cols, r)) for r in cur ]
+
+	def verifyFile(self, row, path):
+		"""
+		Check a local file against its sync database row. Size and mtime are compared
+		first; the file is only hashed again if one of them changed.
+		Only empty or truncated files (see checkFileFormat()) are corrupt. A complete file
+		with another hash was changed locally (e.g. by postproc.sh or the user); its new
+		size, hash and mtime are recorded.
+		Files recorded without hash (older databases) are checked the same way, and their
+		size and hash are recorded.
+		Returns: 'ok', 'modified', 'missing' or 'corrupt'
+		"""
+		try:
+			st = os.stat(path)
+		except OSError:
+			return 'missing'
+		if st.st_size == 0:
+			return 'corrupt'
+		if row['sha256'] is not None and row['mtime'] == st.st_mtime and row['size'] == st.st_size \
+			and row['path'] == os.path.normpath(path):
+			return 'ok'
+		if not self.checkFileFormat(path):
+			return 'corrupt'
+		sha256 = self.hashFile(path)
+		state = 'modified' if row['sha256'] is not None and sha256 != row['sha256'] else 'ok'
+		with self.syncdb_lock:
+			conn = self.openSyncDB()
+			with conn:
+				conn.execute("UPDATE files SET size = ?, sha256 = ?, path = ?, mtime = ? WHERE name = ?",
+					(st.st_size, sha256, os.path.normpath(path), st.st_mtime, row['name']))
+		return state
+
+	@staticmethod
+	def checkFileFormat(path):
+		"""
+		Cheap completeness check: JPEG start/end markers, %%EOF at the end of a PDF
+		"""
+		with open(path, 'rb') as f:
+			head = f.read(8)
+			f.seek(max(0, os.fstat(f.fileno()).st_size - 1024))
+			tail = f.read()
+		if head.startswith(b'\xff\xd8'):
+			return b'\xff\xd9' in tail
+		if head.startswith(b'%PDF'):
+			return b'%%EOF' in tail
+		return True
 
-	def writeSyncDB(self, name):
-		with open(self.SYNC_DB, 'a') as f:
-			f.write(name + "\t" + datetime.datetime.now().isoformat() + "\n")
+	def recordedFolders(self):
+		"""
+		Local folders plus the folders of all paths recorded in the sync database, e.g.
+		the <scanbox>/<recipient> folders of mailingTarget()
+		"""
+		folders = list(self.folders)
+		known = set(os.path.normpath(f) for f in folders)
+		for row in self.syncRows():
+			folder = os.path.normpath(os.path.dirname(row['path'])) if row['path'] else '.'
+			if folder not in known:
+				known.add(folder)
+				folders.append(folder)
+		return folders
+
+	def verifySyncDB(self):
+		"""
+		Verify all files of the sync database, see verifyFile(). Files not at their
+		recorded path are looked up in the local file index of recordedFolders() (e.g.
+		renamed by tags).
+		Envelope and PDF are not missing if the combined file exists.
+		Corrupt files are renamed to <path>.corrupt (see replaceCorrupt()); the rows
+		of missing and corrupt files are removed, so that the next sync of these mailings
+		downloads them again. Modified files are only reported.
+		Returns list of (row, state) for modified, missing and corrupt files; row['path']
+		is the path of the checked file
+		"""
+		self.local_index = None
+		self.buildLocalIndex(self.recordedFolders())
+		bad = []
+		with self.metrics.timer('verify'):
+			for row in self.syncRows():
+				type = getattr(self.TYPE, row['type'], None) if row['type'] else None
+				paths = [ row['path'] ] if row['path'] else []
+				if row['barcode'] and type is not None:
+					paths += [ p for p in self.localFiles(row['barcode'], type) if os.path.normpath(p) not in paths ]
+				paths = paths or [ row['name'] ]
+				state = 'missing'
+				for path in paths:
+					state = self.verifyFile(row, path)
+					if state != 'missing':
+						break
+				if state == 'missing' and type in (self.TYPE.envelope, self.TYPE.pdf) and \
+					any(os.path.isfile(p) for p in self.localFiles(row['barcode'], self.TYPE.full)):
+					state = 'ok'
+				self.metrics.count('verify_' + state)
+				if state == 'ok':
+					continue
+				row = dict(row, path=os.path.normpath(path))
+				if state == 'corrupt':
+					# Keep the file until a replacement was downloaded
+					os.replace(path, path + '.corrupt')
+					self.snapshotUpdate(path, False)
+					self.snapshotUpdate(path + '.corrupt')
+				bad.append((row, state))
+		redo = [ row for (row, state) in bad if state != 'modified' ]
+		with self.syncdb_lock:
+			conn = self.openSyncDB()
+			with conn:
+				conn.executemany("DELETE FROM files WHERE name = ?", [ (row['name'],) for row in redo ])
+				barcodes = set(row['barcode'] for row in redo)
+				conn.executemany("DELETE FROM mailings WHERE barcode = ?", [ (b,) for b in barcodes ])
+			# Allow all files of these mailings to be downloaded again, e.g. envelope and
+			# PDF for a corrupt combined file
+			self.syncdb = set(n for n in self.syncdb if self.parseSyncName(n)[0] not in barcodes)
+		if len(redo) > 0:
+			self.local_index = None
+		return bad
+
+	def replaceCorrupt(self, bad):
+		"""
+		After the corrupt files of verifySyncDB() were synced again: delete the
+		<path>.corrupt copies of files which were downloaded again. The others are kept,
+		so that the next sync downloads them again.
+		Returns list of <path>.corrupt files which were not replaced
+		"""
+		self.local_index = None
+		self.buildLocalIndex(self.recordedFolders())
+		kept = []
+		for (row, state) in bad:
+			if state != 'corrupt':
+				continue
+			type = getattr(self.TYPE, row['type'], None) if row['type'] else None
+			types = [type] + ([self.TYPE.full] if type in (self.TYPE.envelope, self.TYPE.pdf) else [])
+			aside = row['path'] + '.corrupt'
+			if row['barcode'] and type is not None and \
+				any(os.path.isfile(p) for t in types for p in self.localFiles(row['barcode'], t)):
+				os.remove(aside)
+				self.snapshotUpdate(aside, False)
+			else:
+				kept.append(aside)
+		return kept
+
+	def findDuplicates(self, search_folders):
+		"""
+		Find files with identical content in the given folders, regardless of their names.
+		Only files of equal size are hashed; hashes of the sync database are reused
+		while size and mtime are unchanged.
+		Returns list of lists of paths
+		"""
+		self.buildLocalIndex(search_folders)
+		known = {}
+		for row in (self.syncRows() if os.path.exists(self.SYNC_SQLITE) else []):
+			if row['path'] and row['sha256']:
+				known[row['path']] = (row['size'], row['mtime'], row['sha256'])
+		by_size = {}
+		for path in set(self.local_files_cache):
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			if stat.S_ISREG(st.st_mode) and st.st_size > 0 and not path.endswith('.part'):
+				by_size.setdefault(st.st_size, []).append((path, st))
+		by_hash = {}
+		for files in by_size.values():
+			if len(files) < 2:
+				continue
+			for (path, st) in files:
+				k = known.get(os.path.normpath(path))
+				sha256 = k[2] if k is not None and k[:2] == (st.st_size, st.st_mtime) else self.hashFile(path)
+				by_hash.setdefault(sha256, []).append(path)
+		return [ sorted(p) for p in by_hash.values() if len(p) > 1 ]
+
+	def setProxy(self, https_proxy):
+		self.session.proxies = { 'https': https_proxy }
+
+	@property
+	def session(self):
+		"""
+		The requests.Session, created on first use, so that offline modes do not import requests
+		"""
+		if self._session is None:
+			from requests.packages.urllib3.exceptions import InsecureRequestWarning
+			requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+			self._session = requests.Session()
+		return self._session
+
+	def setJobs(self, jobs):
+		"""
+		Set number of mailings downloaded in parallel. The HTTP connection pool is sized to match.
+		"""
+		self.jobs = max(1, jobs)
+		adapter = requests.adapters.HTTPAdapter(pool_connections=self.jobs, pool_maxsize=self.jobs)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+
+	def login(self):
+		""" Login to dropscan.de. Saves cookie and the scanbox ID as class variables. """
+		start = time.monotonic()
+		# Get Auth Token from Login form
+		if self.verbose >= 3: print ("--- Pre-Login ---")
+		r = self.httpRequest('get', self.BASE_URL + '/login')
+		auth = self.loginForm(r.content)
+
+		# Login
+		if self.verbose >= 3: print ("--- Login ---")
+		r = self.httpRequest('post', self.BASE_URL + '/login',
+			data = auth, allow_redirects=True)
+		# STATUS is 200 on error, 302 on success (if not following redirect)
+		if self.verbose >= 3: print ("Status code: ", r.status_code, "\nURL: ", r.url)
+		self.checkLogin(r.url)
+		self.login_count += 1
+		# No relogin on failure: login_lock may be held by the caller
+		self.getScanboxes(relogin=False)
+		self.saveSession()
+		self.metrics.addTime('login', time.monotonic() - start)
+		return True
+
+	def setSessionCache(self, filename):
+		"""
+		File to persist session cookies and scanbox ID between runs (None to disable)
+		"""
+		self.session_cache = filename
+
+	def loginCached(self):
+		"""
+		Restore the session from the session cache, or login() if there is none.
+		An expired session is detected by apiRequest(), which then logs in again.
+		"""
+		if self.loadSession():
+			if self.verbose >= 2: print ("Using cached session, scanbox", self.scanbox)
+			return True
+		return self.login()
+
+	def loadSession(self):
+		"""
+		Load cookies and scanbox ID from the session cache. Returns True on success.
+		"""
+		if self.session_cache is None or not os.path.exists(self.session_cache):
+			return False
+		try:
+			with open(self.session_cache) as f:
+				cache = json.load(f)
+			if cache['user'] != self.user or cache.get('base_url', self.BASE_URL) != self.BASE_URL:
+				return False
+			for c in cache['cookies']:
+				self.session.cookies.set(c['name'], c['value'], domain=c['domain'], path=c['path'])
+			self.setScanboxes(cache['scanboxes'])
+		except (ValueError, KeyError) as e:
+			if self.verbose >= 1: print ("Invalid session cache", self.session_cache, e)
+			return False
+		return True
+
+	def saveSession(self):
+		"""
+		Write cookies and scanbox ID to the session cache, readable only by the user
+		"""
+		if self.session_cache is None:
+			return
+		cache = { 'user': self.user, 'base_url': self.BASE_URL, 'scanbox': self.scanbox,
+			'scanboxes': list(self.scanboxes.values()),
+			'cookies': [ { 'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path }
+				for c in self.session.cookies ] }
+		fd = os.open(self.session_cache, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+		os.fchmod(fd, 0o600)
+		with os.fdopen(fd, 'w') as f:
+			json.dump(cache, f)
+
+	def apiRequest(self, method, url, relogin=True, **kwargs):
+		"""
+		HTTP request with the session, see httpRequest(). On an authentication failure
+		(401/403 or redirect to the login page), login() is called once and the request repeated.
+		relogin -- False to raise on an authentication failure instead (used within login())
+		Returns the requests.Response. Raises AuthError if the request still fails after the login.
+		"""
+		count = self.login_count
+		r = self.httpRequest(method, url, **kwargs)
+		if not self.isAuthFailure(r):
+			return r
+		r.close()
+		if not relogin:
+			raise AuthError("Authentication failed: " + url)
+		with self.login_lock:
+			# Another thread may have logged in already
+			if count == self.login_count:
+				if self.verbose >= 1: print ("Session expired, logging in")
+				self.login()
+		r = self.httpRequest(method, url, **kwargs)
+		if self.isAuthFailure(r):
+			r.close()
+			raise AuthError("Authentication failed after login: " + url)
+		return r
+
+	def setBandwidth(self, rate=0):
+		"""
+		Limit the download bandwidth over all threads
+		rate  -- Bytes per second, 0 for no limit
+		"""
+		self.bandwidth = RateLimiter(rate)
+
+	def throttle(self, n):
+		"""
+		Wait until n more bytes may be downloaded, see setBandwidth()
+		"""
+		wait = self.bandwidth.reserve(n)
+		if wait > 0:
+			time.sleep(wait)
+
+	def httpRequest(self, method, url, **kwargs):
+		"""
+		HTTP request with rate limit, retries and circuit breaker. Connection errors,
+		429 and 5xx are retried with jittered exponential backoff, honoring Retry-After.
+		POST requests are only retried when the server did not process them (429, 503).
+		Raises requests.exceptions.RequestException (CircuitOpenError if the breaker is open)
+		endpoint -- Name for request metrics; derived from the URL if not given
+		"""
+		endpoint = kwargs.pop('endpoint', None) or self.endpointName(url)
+		attempt = 0
+		while True:
+			self.breaker.check()
+			time.sleep(self.rate_limiter.reserve())
+			start = time.monotonic()
+			try:
+				r = self.session.request(method, url, **kwargs)
+			except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+				self.metrics.request(endpoint, None, time.monotonic() - start)
+				self.breaker.failure()
+				if attempt >= self.retries:
+					raise
+				delay = self.retryDelay(attempt)
+				if self.verbose >= 2: print ("Request failed (%s), retry in %.1f s: %s" % (e, delay, url))
+			else:
+				nbytes = 0 if kwargs.get('stream') else len(r.content)
+				self.metrics.request(endpoint, r.status_code, time.monotonic() - start, nbytes)
+				if not self.isRetryable(method, r.status_code):
+					if r.status_code < 500: self.breaker.success()
+					else: self.breaker.failure()
+					return r
+				self.breaker.failure()
+				if attempt >= self.retries:
+					return r
+				delay = self.retryDelay(attempt, r.headers.get('Retry-After'))
+				if self.verbose >= 2: print ("HTTP %d, retry in %.1f s: %s" % (r.status_code, delay, url))
+				r.close()
+			attempt += 1
+			time.sleep(delay)
+
+	def isAuthFailure(self, r):
+		return r.status_code in (401, 403) or re.search('/login$', r.url.split('?')[0]) is not None
+
+	def getScanboxes(self, relogin=True):
+		"""
+		Get info about scanboxes, sets self.scanbox
+		relogin -- Login again if the session expired, see apiRequest()
+		"""
+		r = self.apiRequest('get', self.BASE_URL + '/services/scanboxes', relogin=relogin)
+		self.setScanboxes(r.json())
+
+	def getList(self, filter, incremental=False, scanbox=None, sink=None):
+		"""
+		List of mailings in specified box. Returns list of Mailing.
+		With several selected scanboxes, they are listed in parallel and the lists
+		concatenated; Mailing.scanbox_id tells the scanbox.
+		filter       -- Use self.FILTER enum
+		incremental  -- Stop at the watermark (newest mailing of the last complete sync) of
+		                this filter, see SORTING. Without a watermark, at most list_count
+		                mailings are listed.
+		scanbox      -- List only this scanbox
+		sink         -- Function called with each mailing as soon as its page arrived
+		"""
+		if scanbox is None and len(self.scanbox_ids) > 1:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.scanbox_ids)) as pool:
+				lists = pool.map(lambda sb: self.getList(filter, incremental, sb, sink), self.scanbox_ids)
+				return [ m for l in lists for m in l ]
+		scanbox = scanbox or self.scanbox
+		filter_str = self.FILTER.reverse_mapping[filter]
+		# Watermark key: status for the account's first scanbox (as before), else scanbox:status
+		key = filter_str if scanbox == next(iter(self.scanboxes), scanbox) else scanbox + ':' + filter_str
+		field = self.SORTING.get(filter_str)
+		watermark = self.watermarks.get(key) if incremental and field else None
+		if watermark is not None and field not in watermark:
+			# Watermark of an older version, sorted by another field
+			watermark = None
+		mailings = []
+		with self.metrics.timer('listing'):
+			for m in self.iterList(filter, scanbox):
+				if watermark and self.isOlderOrSame(m, watermark, field):
+					break
+				mailings.append(m)
+				if sink is not None:
+					sink(m)
+				if watermark is None and len(mailings) >= self.list_count:
+					break
+		if len(mailings) > 0 and field and mailings[0].get(field):
+			self.watermarks_new[key] = { field: mailings[0][field], 'id': mailings[0]['id'] }
+		if self.verbose >= 3:
+			print("--- getList", filter_str, len(mailings), " mailings ---")
+		return mailings
+
+	def iterLists(self, filters=None, incremental=False):
+		"""
+		Mailings of several filters (default: all) and all selected scanboxes, listed
+		concurrently, see getList(). Mailings are yielded as soon as their page arrives,
+		each mailing ID only once (a mailing changing its status during the listing could
+		show up twice). Listing errors are raised after all listings ended.
+		"""
+		if filters is None:
+			filters = [self.FILTER.scanned, self.FILTER.received, self.FILTER.forwarded, self.FILTER.destroyed]
+		tasks = [ (f, sb) for f in filters for sb in (self.scanbox_ids or [self.scanbox]) ]
+		pages = queue.Queue()
+		done = object()
+		def listTask(filter, scanbox):
+			try:
+				self.getList(filter, incremental, scanbox, pages.put)
+			finally:
+				pages.put(done)
+		seen = set()
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+			futures = [ pool.submit(listTask, f, sb) for (f, sb) in tasks ]
+			running = len(futures)
+			while running > 0:
+				m = pages.get()
+				if m is done:
+					running -= 1
+				elif m['id'] not in seen:
+					seen.add(m['id'])
+					yield m
+		for fut in futures:
+			fut.result()
+
+	def iterList(self, filter, scanbox=None):
+		"""
+		Iterate over all mailings in specified box, newest first, requesting one page at a time
+		filter  -- Use self.FILTER enum
+		scanbox -- Scanbox ID, default self.scanbox
+		"""
+		filter_str = self.FILTER.reverse_mapping[filter]
+		scanbox = scanbox or self.scanbox
+		page_size = min(self.list_count, self.PAGE_SIZE)
+		page = 0
+		while True:
+			url = self.listUrl(filter_str, page_size, page, scanbox)
+			if self.verbose >= 3: print(url)
+			mailings = self.getJSON(url)
+			for m in mailings:
+				yield Mailing(m, scanbox)
+			if len(mailings) < page_size:
+				return
+			page += 1
 
-	def setProxy(self, https_proxy):
-		self.session.proxies = { 'https': https_proxy }
+	def getJSON(self, url):
+		"""
+		GET a JSON document. Sends ETag / Last-Modified of the previous response for
+		this URL, and reuses its data if the server answers 304 Not Modified.
+		"""
+		cached = self.http_cache.get(url)
+		headers = {}
+		if cached is not None:
+			if cached[0]: headers['If-None-Match'] = cached[0]
+			if cached[1]: headers['If-Modified-Since'] = cached[1]
+		r = self.apiRequest('get', url, headers=headers)
+		if r.status_code == 304 and cached is not None:
+			if self.verbose >= 3: print ("Not modified:", url)
+			return cached[2]
+		data = r.json()
+		etag = r.headers.get('ETag')
+		modified = r.headers.get('Last-Modified')
+		if etag or modified:
+			self.http_cache[url] = (etag, modified, data)
+		return data
 
-	def setListCount(self, count):
+	def watch(self, thumbs=False, min_interval=60, max_interval=3600):
 		"""
-		Set number of items to request from dropscan; their default is 20
+		Poll the mailing lists until stop() is called (e.g. on SIGTERM) and sync
+		mailings that are new or whose status changed. The poll interval starts at
+		min_interval after new mail and doubles up to max_interval while idle or
+		while requests or the login (AuthError) fail.
 		"""
-		self.list_count = count
+		if self.statuses is None:
+			self.statuses = {}
+		interval = min_interval
+		self.stop_event.clear()
+		while not self.stop_event.is_set():
+			try:
+				changed = self.statusDelta(self.iterLists())
+				if len(changed) > 0:
+					if self.verbose >= 1: print ("Watch: %d new or changed mailing(s)" % (len(changed)))
+					# Files were written or renamed since the last sync
+					self.local_index = None
+					# Mailings with errors are not recorded and looked at again in the next poll
+					self.syncMailings(changed, thumbs)
+					interval = min_interval
+				else:
+					interval = min(interval * 2, max_interval)
+			except (requests.exceptions.RequestException, AuthError) as e:
+				# E.g. maintenance page or expired session: back off, login again in the next poll
+				print ("Watch: request failed:", e)
+				interval = min(interval * 2, max_interval)
+			if self.verbose >= 2: print ("Watch: next poll in %d s" % (interval))
+			self.stop_event.wait(interval)
 
-	def login(self):
-		""" Login to dropscan.de. Saves cookie and the scanbox ID as class variables. """
-		# Get Auth Token from Login form
-		if self.verbose >= 3: print ("--- Pre-Login ---")
-		r = self.session.get('https://secure.dropscan.de/login')
-		d = pq(r.content)
-		auth_token = d('meta[name="csrf-token"]').attr("content")
-		if auth_token is None: print("Error: No auth token")
-		if self.verbose >= 3: print ("Auth token: ", auth_token)
+	def stop(self):
+		"""
+		Stop watch() after the current poll
+		"""
+		self.stop_event.set()
 
-		# Login
-		if self.verbose >= 3: print ("--- Login ---")
-		auth = { 'user[email]': self.user, 'user[password]': self.password, 'user[remember_me]': 0,
-		'authenticity_token': auth_token}
-		r = self.session.post('https://secure.dropscan.de/login',
-			data = auth, allow_redirects=True)
-		# STATUS is 200 on error, 302 on success (if not following redirect)
-		if self.verbose >= 3: print ("Status code: ", r.status_code, "\nURL: ", r.url)
+	def isOlderOrSame(self, mailing, watermark, field='created_at'):
+		"""
+		Check whether mailing is at or behind watermark (dict with field, id)
+		field -- Timestamp the list is sorted by, see SORTING
+		"""
+		if mailing['id'] == watermark['id']:
+			return True
+		if field == 'created_at':
+			return Mailing.of(mailing).created < isodate.parse_datetime(watermark[field])
+		if not mailing.get(field):
+			return False
+		return isodate.parse_datetime(mailing[field]) < isodate.parse_datetime(watermark[field])
 
-		# Get scanbox-id from URL. Login results in a 302 forward to the scanbox URL.
-		m = re.search('.*/mailings$', r.url)
-		if m is None:
-			raise Exception("Login error.");
-		self.getScanboxes()
-		return True
+	def readWatermarks(self):
+		"""
+		Read watermarks of the last complete sync, per status
+		"""
+		if os.path.exists(self.WATERMARK_DB):
+			with open(self.WATERMARK_DB) as f:
+				state = json.load(f)
+		else:
+			state = {}
+		self.watermarks = state.get('watermarks', {})
+		self.full_listing_at = state.get('full_listing_at')
 
-	def getScanboxes(self):
+	def writeWatermarks(self, full_listing=False):
 		"""
-		Get info about scanboxes, sets self.scanbox
+		Store watermarks of the lists fetched in this run. Only call after a complete sync
+		without failed mailings (see sync_errors and failed_ids).
+		full_listing -- This run listed everything, i.e. was a reconciliation
 		"""
-		r = self.session.get('https://secure.dropscan.de/services/scanboxes')
-		scanboxes = r.json()
-		self.scanbox = scanboxes[0]['id']
-		if self.verbose >= 2:
-			print("Scanbox ID:", self.scanbox, "Receipients:", ','.join([r['name'] for r in scanboxes[0]['recipients']]))
-		
+		self.watermarks.update(self.watermarks_new)
+		if full_listing:
+			self.full_listing_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+		with open(self.WATERMARK_DB, 'w') as f:
+			json.dump({ 'watermarks': self.watermarks, 'full_listing_at': self.full_listing_at }, f, indent=2)
 
-	def getList(self, filter):
+	def needsFullListing(self, max_age_hours):
 		"""
-		List of mailings in specified box. Returns the JSON-struct from Dropscan directly.
-		filter -- Use self.FILTER enum
+		True if the last full (reconciling) listing is older than max_age_hours or unknown.
+		Incremental listings miss status changes of older mailings, so they have to be
+		reconciled from time to time.
 		"""
-		filter_str = self.FILTER.reverse_mapping[filter]
-		# https://secure.dropscan.de/services/mailings?max_per_page=100&scanbox_ids=1834&sort_dir=desc&sorting=scanned_at&statuses=scanned
-		#url = 'https://secure.dropscan.de/scanboxes/' + \
-		url = 'https://secure.dropscan.de/services/mailings?sort_dir=desc&sorting=created_at&' + \
-			"scanbox_ids=" + self.scanbox + '&statuses=' + filter_str + '&max_per_page=' + str(self.list_count)
-		r = self.session.get(url)
-		mailings = r.json()
-		if self.verbose >= 3:
-			print("--- getList", filter_str, len(mailings), " mailings ---")
-			print(url)
-		return mailings
+		if self.full_listing_at is None or len(self.watermarks) == 0:
+			return True
+		age = datetime.datetime.now(datetime.timezone.utc) - isodate.parse_datetime(self.full_listing_at)
+		return age > datetime.timedelta(hours=max_age_hours)
 
 	def getBatches(self, only_unsent=True):
 		"""
 		Get list of all forwarding batches
 		Returns the JSON-struct from Dropscan, adds is_sent flag
 		"""
-		r = self.session.get('https://secure.dropscan.de/services/forwarding_batches?max_per_page=100&page=0')
-		batches = r.json()
-		batches = [ b.update({'is_sent': 'sent_at' in b and b['sent_at'] is not None }) or b for b in batches ]
-		batches = [ b for b in batches if not b['is_sent'] or not only_unsent ]
-		batches.sort(key=lambda e: e['requested_for'])
-		return batches
+		r = self.apiRequest('get', self.batchesUrl())
+		return self.filterBatches(r.json(), only_unsent)
 
 	def addMailingtoBatch(self, mailing, batch=None):
 		"""
@@ -148,148 +1619,378 @@ class Dropscan:
 		batch         -- Batch struct, as returned by getBatches. If unspecified, the first unsent batch is used.
 		Returns: added, alreadyin, nobatch, error
 		"""
-		# Get batch struct, if unspecified
+		return self.forwardMailings([mailing], batch)[mailing['id']]
+
+	def forwardMailings(self, mailings, batch=None):
+		"""
+		Adds many mailings to a forwarding batch. Batches are listed only once per
+		instance (see getBatchesCached), and the request_forward POSTs are sent with
+		up to self.jobs in parallel.
+		mailings      -- mailings to add, only field id is required
+		batch         -- Batch struct, as returned by getBatches. If unspecified, the first unsent batch is used.
+		Returns: dict mailing id -> added, alreadyin, nobatch, error
+		"""
+		results = {}
 		if batch is None:
-			batches = self.getBatches()
-			# print(batches)
+			batches = self.getBatchesCached()
 			if len(batches) == 0:
 				if self.verbose >= 1: print ("No unsent batch available")
-				return "nobatch"
+				return { m['id']: "nobatch" for m in mailings }
 			batch = batches[0]
-		# Check if mailing already in batch
-		for m in batch['mailings']:
-			if m == mailing['id'] or ('forwarding_batch_id' in mailing and mailing['forwarding_batch_id'] is not None):
+		batched = self.batchedIds()
+		todo = []
+		for m in mailings:
+			if m['id'] in results:
+				continue
+			# Check if mailing already in batch
+			if m['id'] in batched or m.get('forwarding_batch_id') is not None:
 				if self.verbose >= 1: print ("Mailing", m['id'], "already in batch")
-				return "alreadyin"
-		# Add mailing to batch
-		r = self.session.post('https://secure.dropscan.de/services/mailings/%s/request_forward' %
-			(mailing['id']), json = { "forwarding_batch_id": batch['id'] } )
-		ok = r.status_code == 200
+				results[m['id']] = "alreadyin"
+			else:
+				results[m['id']] = None
+				todo.append(m)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+			for (m, res) in zip(todo, pool.map(lambda m: self.requestForward(m, batch), todo)):
+				results[m['id']] = res
+				if res == "added":
+					batch['mailings'].append(m['id'])
+					batched.add(m['id'])
+		return results
+
+	def requestForward(self, mailing, batch):
+		"""
+		POST request_forward for one mailing. Returns: added, error
+		"""
+		try:
+			r = self.apiRequest('post', self.forwardUrl(mailing), json = { "forwarding_batch_id": batch['id'] } )
+			ok = r.status_code == 200
+		except requests.exceptions.RequestException:
+			ok = False
 		if not ok and self.verbose >= 1:
 			print ("Failed to add mailing", mailing['id'], "to batch")
 		return "added" if ok else "error"
 
+	def getBatchesCached(self, only_unsent=True):
+		"""
+		getBatches(), but the batch list is requested only once per instance.
+		Set self.batches_cache = None to refresh.
+		"""
+		if self.batches_cache is None:
+			self.batches_cache = self.getBatches(only_unsent=False)
+		return [ b for b in self.batches_cache if not b['is_sent'] or not only_unsent ]
+
+	def batchedIds(self):
+		"""
+		Set of ids of all mailings in any listed forwarding batch
+		"""
+		ids = set()
+		for b in self.getBatchesCached(only_unsent=False):
+			for m in b['mailings']:
+				ids.add(m['id'] if isinstance(m, dict) else m)
+		return ids
 
 	def addFolderstoBatch(self, mailings, forward_folders):
 		"""
 		Add all mailing files (envelopes) found in any of folders to forwarding batch.
 		mailings         -- Mailings struct from getList()
 		forward_folders  -- List of folders with mailings to be forwarded
+		Returns number of added mailings
 		"""
-		count = 0
-		# Build local files DB
-		self.localFileMailing(mailings[0], self.TYPE.envelope, forward_folders)
-		for m in reversed(mailings):
-			# Check mailing status
-			if not (m['status'] == 'scanned' or m['status'] == 'received'):
-				continue
-			# Check for local file
-			r1 = re.compile('.*[-_\. ]' + m['barcode'] + '[-_\. ]')
-			local_files = list(filter(r1.match, self.local_files_cache))
-
-			# If file is found,
-			if len(local_files) > 0:
-				res = self.addMailingtoBatch(m)
-				if res == 'added':
-					count += 1
-					print ("Adding mailing to batch:", local_files[0])
-				elif res == 'error':
-					print ("Error adding mailing to batch:", local_files[0])
-		return count
-		
+		return self.executeForward(self.planForward(mailings, forward_folders=forward_folders), mailings)
 
 	def addOldtoBatch(self, mailings, older_days):
 		"""
 		Add mailings older than older_days to batch
+		Returns number of added mailings
 		"""
-		count = 0
-		for m in mailings:
-			if not (m['status'] == 'scanned' or m['status'] == 'received'):
-				continue
-			ndays = (datetime.datetime.now(datetime.timezone.utc) - isodate.parse_datetime(m['created_at'])).days
-			if ndays > older_days:
-				res = self.addMailingtoBatch(m)
+		return self.executeForward(self.planForward(mailings, older_days=older_days), mailings)
+
+	def planForward(self, mailings, forward_folders=None, older_days=None):
+		"""
+		Decide which mailings to add to the forwarding batch, without sending anything.
+		Only scanned or received mailings are forwarded. Whether a mailing already is in
+		a batch is checked when executing, see executeForward().
+		forward_folders  -- Forward mailings with a file in any of these folders
+		older_days       -- Forward mailings older than this number of days
+		Returns list of actions (JSON serializable dicts): forward (reason: folder, with file,
+		or age, with days)
+		"""
+		actions = []
+		mailings = [ m for m in map(Mailing.of, mailings) if m.status == 'scanned' or m.status == 'received' ]
+		if forward_folders:
+			# Build local files DB
+			self.buildLocalIndex(forward_folders)
+			for m in reversed(mailings):
+				# Check for local file
+				local_files = self.localFiles(m.barcode)
+				if len(local_files) > 0:
+					actions.append({ 'action': 'forward', 'mailing': m.id, 'barcode': m.barcode, 'reason': 'folder', 'file': local_files[0] })
+		if older_days is not None:
+			now = datetime.datetime.now(datetime.timezone.utc)
+			for m in mailings:
+				ndays = (now - m.created).days
+				if ndays > older_days:
+					actions.append({ 'action': 'forward', 'mailing': m.id, 'barcode': m.barcode, 'reason': 'age', 'days': ndays })
+		return actions
+
+	def executeForward(self, actions, mailings):
+		"""
+		Add the mailings of forward actions (see planForward()) to the forwarding batch, in one go
+		mailings  -- Mailings the actions were planned for
+		Returns number of added mailings
+		"""
+		by_id = { m['id']: m for m in mailings }
+		results = self.forwardMailings([ by_id[a['mailing']] for a in actions ])
+		for a in actions:
+			res = results.pop(a['mailing'], None)
+			if a['reason'] == 'folder':
 				if res == 'added':
-					count += 1
-					print ("Added old mailing %s (%d days) to batch." % (m['id'], ndays))
+					print ("Adding mailing to batch:", a['file'])
 				elif res == 'error':
-					print ("Error adding old mailing %s to batch." % (m['id']))
-		return count
+					print ("Error adding mailing to batch:", a['file'])
+			else:
+				if res == 'added':
+					print ("Added old mailing %s (%d days) to batch." % (a['mailing'], a['days']))
+				elif res == 'error':
+					print ("Error adding old mailing %s to batch." % (a['mailing']))
+			if res is not None:
+				results[a['mailing']] = res
+		return list(results.values()).count('added')
 
-	def downloadMailing(self, mailing, type, filename=""):
+	def downloadMailing(self, mailing, type, filename="", stream=False):
 		"""
 		Download thumb, envelope (JPG) or PDF for a mailing.
 		Uses subfolders for recipients, if they exist
 		mailing   -- One entry returned from getList()
 		type      -- Thumbnail, envelope or full PDF. Use self.TYPE enum.
 		filename  -- Save to given file. If empty, return the JPG/PDF stream
-		Rerturns:	 True (written to file), Contents, False (error), None (nothing to download)
+		stream    -- Without filename: return an iterator of chunks instead of bytes
+		Rerturns:	 Filename (written to file), Contents, False (error), None (nothing to download)
 		"""
 		m = mailing
-		#url_json ='https://secure.dropscan.de/scanboxes/' + \
-		#		self.scanbox + '/mailings/' + mailing['slug'] + '.json'
-		#r = self.session.get(url_json)
-		#m = r.json()
-
-		if type == self.TYPE.thumb:
-			url = m['envelope_thumbnail_url']
-		elif type == self.TYPE.envelope:
-			# The URL of the large envelope is *.jpg instead of *.small.jpg
-			# Otherwise, this would have to be extracted from /scanboxes/*/mailings/*
-			#OLD url = re.sub(r'^(.*)\.small\.(.*)$', r'\1.\2', m['envelope_thumbnail_url']);
-			url = m['envelope_url']
-		elif type == self.TYPE.pdf:
-			if not 'scanned_at' in m or not m['scanned_at']:
-				if self.verbose >=2: print ("Mailing %s not (yet) scanned" % (m['barcode']))
-				return None
-			url = "https://secure.dropscan.de/services/mailings/" + m['id'] + "/pdf?src="
-			#OLD url = 'https://secure.dropscan.de/scanboxes/' + self.scanbox + '/mailings/' + m['slug'] + '/download_pdf'
-		elif type == self.TYPE.zip:
-			raise Exception("ZIP download not implemented.")
-
+		url = self.mailingUrl(m, type)
+		if url is None:
+			return None
 		if self.verbose >= 3: print ("--- Download mailing %s (%s) ---" % (m['barcode'], self.TYPE.reverse_mapping[type]))
-		# Determine filename - sort by receipient first name
-		rec = m['recipient'].split(" ")[0]
-		if os.path.isdir(rec):
-			filename = rec + os.sep + filename
-		elif self.verbose >= 2:
-			print('Sorting by receipient: Folder "%s" not found')
+		filename = self.mailingTarget(m, filename)
+		endpoint = self.TYPE.reverse_mapping[type]
+		if len(filename) > 0:
+			# Already extracted from a bulk ZIP download, see prefetchZip()
+			path = self.prefetched.pop((m['id'], type), None)
+			if path is not None and os.path.isfile(path):
+				return path
+			with self.metrics.timer('download'):
+				return self.downloadFile(url, filename, endpoint)
 		# HTTP GET
-		r = self.session.get(url, verify=False)
+		r = self.apiRequest('get', url, verify=False, stream=stream, endpoint=endpoint)
 		if r.status_code != 200:
 			if self.verbose >= 2:
 				print("Invalid HTTP status code", r.status_code, "on URL", url)
+			r.close()
 			return False
-		if len(filename) > 0:
-			with open(filename, 'wb') as fd:
-				fd.write(r.content)
-			return filename
-		else:
-			return r.content
+		if stream:
+			return r.iter_content(chunk_size=self.CHUNK_SIZE)
+		return r.content
+
+	def downloadFile(self, url, filename, endpoint=None):
+		"""
+		Stream URL to filename. Data is written to <filename>.part, synced and renamed
+		when complete, so a killed process never leaves a truncated file behind.
+		An existing .part file is resumed with a Range request, if the server supports it.
+		Returns: filename, or False on error
+		"""
+		tmp = filename + '.part'
+		offset = os.path.getsize(tmp) if os.path.isfile(tmp) else 0
+		headers = { 'Range': 'bytes=%d-' % (offset) } if offset > 0 else {}
+		try:
+			r = self.apiRequest('get', url, verify=False, stream=True, headers=headers, endpoint=endpoint)
+		except requests.exceptions.RequestException as e:
+			if self.verbose >= 2: print ("Download failed:", filename, e)
+			return False
+		with r:
+			action = self.resumeAction(url, r.status_code, r.headers.get('Content-Range'), offset)
+			if action == 'restart':
+				os.remove(tmp)
+				return self.downloadFile(url, filename, endpoint)
+			if action is None:
+				return False
+			# Hash while streaming, so that writeSyncDB() does not read the file again
+			h = hashlib.sha256()
+			if action == 'append':
+				if self.verbose >= 2: print ("Resuming download of", filename, "at", offset)
+				self.hashFile(tmp, h)
+			try:
+				with open(tmp, 'ab' if action == 'append' else 'wb') as fd:
+					for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
+						fd.write(chunk)
+						h.update(chunk)
+						self.metrics.addBytes(endpoint or self.endpointName(url), len(chunk))
+						self.throttle(len(chunk))
+					fd.flush()
+					os.fsync(fd.fileno())
+			except requests.exceptions.RequestException as e:
+				# Keep .part for a later resume
+				if self.verbose >= 2: print ("Download interrupted:", filename, e)
+				return False
+		os.replace(tmp, filename)
+		self.snapshotUpdate(filename)
+		self.file_hashes[filename] = h.hexdigest()
+		return filename
+
+	def setZipDownload(self, enabled=True, batch=None, path=None):
+		"""
+		Download envelopes and PDFs of new mailings in bulk as ZIP archives, see prefetchZip().
+		Experimental: secure.dropscan.de offers no ZIP endpoint; every archive would fail
+		and its files be downloaded one by one.
+		batch -- Number of mailings per archive
+		path  -- URL path of the ZIP endpoint (default ZIP_PATH, as in dropscan_mock.py)
+		"""
+		self.zip_download = enabled
+		if batch:
+			self.ZIP_BATCH = batch
+		if path:
+			self.ZIP_PATH = path
+
+	def prefetchZip(self, actions):
+		"""
+		Download the planned envelopes and PDFs (see planMailing()), in bulk as ZIP
+		archives of ZIP_BATCH mailings each (in parallel with self.jobs > 1). The archives
+		are extracted while streaming, to the filenames downloadMailing() would use, and
+		downloadMailing() then returns these files instead of requesting them. Files
+		missing in an archive, or of a failed archive, are downloaded one by one.
+		Returns number of extracted files
+		"""
+		wanted = {}
+		for a in actions:
+			if a['action'] == 'download' and a['type'] in ('envelope', 'pdf'):
+				wanted[(a['mailing'], getattr(self.TYPE, a['type']))] = a['file']
+		ids = list(dict.fromkeys([ id for (id, f) in wanted ]))
+		batches = [ ids[i:i + self.ZIP_BATCH] for i in range(0, len(ids), self.ZIP_BATCH) ]
+		if self.verbose >= 1 and len(batches) > 0:
+			print ("Bulk download of %d mailing(s) in %d ZIP archive(s)" % (len(ids), len(batches)))
+
+		def target(name):
+			# <id>_envelope.jpg / <id>.pdf
+			e = re.match(r'^(.+?)(_envelope)?\.(jpg|pdf)$', os.path.basename(name))
+			if e is None:
+				return None
+			return wanted.get((e.group(1), self.TYPE.envelope if e.group(2) else self.TYPE.pdf))
+
+		def fetch(batch):
+			url = self.zipUrl([ { 'id': id } for id in batch ])
+			try:
+				r = self.apiRequest('get', url, verify=False, stream=True, endpoint='zip')
+			except requests.exceptions.RequestException as e:
+				print ("ZIP download failed:", e)
+				return []
+			with r:
+				if r.status_code != 200:
+					if self.verbose >= 1: print ("Invalid HTTP status code", r.status_code, "on URL", url)
+					return []
+				def read(n):
+					data = r.raw.read(n)
+					self.metrics.addBytes('zip', len(data))
+					self.throttle(len(data))
+					return data
+				try:
+					with self.metrics.timer('download'):
+						return unzipStream(read, target, self.CHUNK_SIZE)
+				except (ValueError, zlib.error, OSError, requests.exceptions.RequestException) as e:
+					print ("ZIP download failed:", e)
+					return []
+
+		count = 0
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+			for files in pool.map(fetch, batches):
+				for (name, path, sha256) in files:
+					e = re.match(r'^(.+?)(_envelope)?\.(jpg|pdf)$', os.path.basename(name))
+					self.prefetched[(e.group(1), self.TYPE.envelope if e.group(2) else self.TYPE.pdf)] = path
+					self.file_hashes[path] = sha256
+					self.snapshotUpdate(path)
+					count += 1
+		self.metrics.count('files_unzipped', count)
+		return count
+
+	def setCombineBackend(self, backend):
+		"""
+		Backend for combineFiles: 'python' (pypdf, no external processes),
+		'tools' (convert + pdftk) or 'auto' (python if pypdf is installed)
+		"""
+		self.combine_backend = backend
+		self.tools_checked = False
+
+	def checkCombineTools(self):
+		"""
+		Print missing tools or packages of the combine backend. Done once, before the first combineFiles().
+		"""
+		self.tools_checked = True
+		if self.combine_backend == 'tools' or (self.combine_backend == 'auto' and pypdf is None):
+			for tool in [ 'convert', 'pdftk' ]:
+				if shutil.which(tool) is None:
+					print("Missing, please install:", tool)
+		elif self.combine_backend == 'python' and pypdf is None:
+			print("Missing, please install: pypdf")
 
 	def combineFiles(self, file_envelope, file_pdf):
 		"""
 		Combines the envelope JPG and the mailing PDF into single file
 		"""
-		tmp_env = file_envelope + '.pdf'
-		ret2 = 1
-
+		if not self.tools_checked:
+			self.checkCombineTools()
 		file_full = file_pdf.replace('_pdf', '')
 		if os.path.isfile(file_full):
 			if self.verbose >= 3: print("Cannot combine to %s; file exists" % (file_full))
 			return False
 
-		ret1 = os.system('convert "%s" "%s"' % (file_envelope, tmp_env))
-		if ret1 == 0:
-			ret2 = os.system('pdftk "%s" "%s" cat output "%s"' % (file_pdf, tmp_env, file_full))
-			if ret2 == 0 and os.path.exists(file_full):
-				os.remove(file_pdf)
-				os.remove(file_envelope)
+		backend = self.combine_backend
+		if backend == 'auto':
+			backend = 'python' if pypdf is not None else 'tools'
+		with self.metrics.timer('combine'):
+			if backend == 'python':
+				ok = self.combineFilesPython(file_envelope, file_pdf, file_full)
+			else:
+				ok = self.combineFilesTools(file_envelope, file_pdf, file_full)
+		if ok and os.path.exists(file_full):
+			os.remove(file_pdf)
+			os.remove(file_envelope)
+			self.snapshotUpdate(file_full)
+			self.snapshotUpdate(file_pdf, False)
+			self.snapshotUpdate(file_envelope, False)
+			self.metrics.count('mailings_combined')
+			return file_full
+		return False
+
+	def combineFilesPython(self, file_envelope, file_pdf, file_full):
+		"""
+		Append the envelope as last page to the PDF, in-process. The JPEG is embedded
+		as is (DCTDecode), without re-encoding. Runs in self.combine_pool, if set.
+		"""
+		try:
+			if self.combine_pool is not None:
+				self.combine_pool.submit(combinePdf, file_envelope, file_pdf, file_full).result()
+			else:
+				combinePdf(file_envelope, file_pdf, file_full)
+		except Exception as e:
+			if self.verbose >= 1: print ("Combining failed:", e)
+			return False
+		return True
+
+	def combineFilesTools(self, file_envelope, file_pdf, file_full):
+		"""
+		Combine using ImageMagick convert and pdftk
+		"""
+		tmp_env = file_envelope + '.pdf'
+		ret1 = ret2 = 1
+		try:
+			ret1 = subprocess.call(['convert', file_envelope, tmp_env])
+			if ret1 == 0:
+				ret2 = subprocess.call(['pdftk', file_pdf, tmp_env, 'cat', 'output', file_full])
+		except OSError as e:
+			# Tool not installed, see checkCombineTools()
+			if self.verbose >= 1: print ("Combining failed:", e)
 		if os.path.exists(tmp_env):
 			os.remove(tmp_env)
-		if (ret1 == 0) and (ret2 == 0): return file_full
-		else: return False
-
+		return (ret1 == 0) and (ret2 == 0)
 
 	def setLocalFolders(self, folders):
 		"""
@@ -299,7 +2000,157 @@ class Dropscan:
 		else: self.folders = folders + ['.']
 		self.folders = list(set(self.folders))  # Unique elements
 		if self.verbose >= 3: print ("Local folders: ", self.folders)
-		self.local_files = None
+		self.local_index = None
+
+	def readSnapshot(self):
+		"""
+		Read the directory snapshot of the last run, see scanFolder()
+		"""
+		try:
+			with open(self.SNAPSHOT_DB) as f:
+				self.snapshot = json.load(f)['dirs']
+		except (OSError, ValueError, KeyError):
+			self.snapshot = {}
+
+	def writeSnapshot(self):
+		"""
+		Store the directory snapshot. Folders modified shortly before they were listed
+		are left out, as a later change within the mtime resolution would go unnoticed.
+		"""
+		if self.snapshot is None:
+			return
+		with self.snapshot_lock:
+			dirs = { k: e for (k, e) in self.snapshot.items() if e['mtime'] < e['scanned'] - 2 }
+		with open(self.SNAPSHOT_DB + '.part', 'w') as f:
+			json.dump({ 'dirs': dirs }, f)
+		os.replace(self.SNAPSHOT_DB + '.part', self.SNAPSHOT_DB)
+
+	def scanFolder(self, folder):
+		"""
+		Files and subfolders of a folder. The folder is only listed (with os.scandir)
+		if its mtime differs from the snapshot; otherwise the entries are taken from there.
+		Returns (files, dirs), lists of names
+		"""
+		if self.snapshot is None:
+			self.readSnapshot()
+		key = os.path.normpath(folder)
+		try:
+			mtime = os.stat(key).st_mtime
+		except OSError:
+			return ([], [])
+		with self.snapshot_lock:
+			e = self.snapshot.get(key)
+		if e is not None and e['mtime'] == mtime:
+			self.metrics.count('snapshot_hits')
+			return (e['files'], e['dirs'])
+		files = []
+		dirs = []
+		scanned = time.time()
+		with os.scandir(key) as it:
+			for d in it:
+				(dirs if d.is_dir(follow_symlinks=False) else files).append(d.name)
+		with self.snapshot_lock:
+			self.snapshot[key] = { 'mtime': mtime, 'scanned': scanned, 'files': files, 'dirs': dirs }
+		self.metrics.count('snapshot_scans')
+		return (files, dirs)
+
+	def walkFolders(self, top):
+		"""
+		top and all its subfolders, like os.walk(), using scanFolder()
+		"""
+		folders = []
+		queue = collections.deque([top])
+		while queue:
+			folder = queue.popleft()
+			folders.append(folder)
+			queue.extend([ os.path.join(folder, d) for d in self.scanFolder(folder)[1] ])
+		return folders
+
+	def snapshotUpdate(self, path, exists=True):
+		"""
+		Add (or remove) a file written (or deleted) by this process to the snapshot of its
+		folder, so that the folder need not be listed again
+		"""
+		if self.snapshot is None:
+			return
+		key = os.path.normpath(os.path.dirname(path) or '.')
+		name = os.path.basename(path)
+		with self.snapshot_lock:
+			e = self.snapshot.get(key)
+			if e is None:
+				return
+			files = [ f for f in e['files'] if f != name ]
+			if exists:
+				files.append(name)
+			try:
+				mtime = os.stat(key).st_mtime
+			except OSError:
+				del self.snapshot[key]
+				return
+			self.snapshot[key] = { 'mtime': mtime, 'scanned': time.time(), 'files': files, 'dirs': e['dirs'] }
+
+	def snapshotInvalidate(self, path):
+		"""
+		Forget the snapshot of the folder of path, e.g. after postproc.sh may have changed it
+		"""
+		if self.snapshot is None:
+			return
+		with self.snapshot_lock:
+			self.snapshot.pop(os.path.normpath(os.path.dirname(path) or '.'), None)
+
+	def buildLocalIndex(self, search_folders):
+		"""
+		Scan the given folders once and index all files by barcode.
+		Every token following a separator [-_. ] is a barcode candidate, so renamed
+		files (e.g. by postproc.sh) are found as well. Sets self.local_files_cache
+		(list of paths) and self.local_index (barcode -> list of LocalFile).
+		"""
+		if search_folders == self.local_folders_cache and self.local_index is not None:
+			return self.local_index
+		start = time.monotonic()
+		self.local_files_cache = []
+		self.local_index = {}
+		for folder in search_folders:
+			if folder[-1] != os.sep: folder += os.sep
+			for f in self.scanFolder(folder)[0]:
+				self.indexLocalFile(folder + f)
+		self.metrics.addTime('index', time.monotonic() - start)
+		self.metrics.gauge('local_index_files', len(self.local_files_cache))
+		self.metrics.gauge('local_index_keys', len(self.local_index))
+		self.metrics.gauge('local_index_build_seconds', round(time.monotonic() - start, 6))
+		if self.verbose >= 3:
+			print("Created file index with", len(self.local_files_cache), "files and", len(self.local_index), "keys")
+		self.local_folders_cache = search_folders
+		return self.local_index
+
+	def indexLocalFile(self, path):
+		"""
+		Parse a filename into LocalFile entries and add them to the index
+		"""
+		self.local_files_cache.append(path)
+		name = os.path.basename(path)
+		d = self.RE_DATE.match(name)
+		date = d.group(1) if d else None
+		seen = set()
+		for t in self.RE_TOKEN.finditer(name):
+			code = t.group(1)
+			if code in seen: continue
+			seen.add(code)
+			tail = self.RE_TAIL.match(name, t.end())
+			if tail:
+				type = getattr(self.TYPE, tail.group(2)) if tail.group(2) else self.TYPE.full
+				entry = LocalFile(path, date, code, tail.group(1), type, tail.group(3))
+			else:
+				entry = LocalFile(path, date, code, None, None, os.path.splitext(name)[1][1:])
+			self.local_index.setdefault(code, []).append(entry)
+
+	def localFiles(self, barcode, type=None, ext=None):
+		"""
+		Look up indexed local files for a barcode, optionally restricted to a type / extension.
+		Returns list of paths.
+		"""
+		entries = self.local_index.get(barcode, []) if self.local_index is not None else []
+		return [ e.path for e in entries if (type is None or e.type == type) and (ext is None or e.ext == ext) ]
 
 	def localFileMailing(self, mailing, type, search_folders):
 		"""
@@ -312,156 +2163,522 @@ class Dropscan:
 		filename        -- Filename for this mailing, constructed from mailing id and type
 		local_path      -- local_file found for this mailing if existing, or None
 		"""
-		m = mailing
-		# Create list of local files, if needed
-		if search_folders != self.local_folders_cache:
-			self.local_files_cache = []
-			for folder in search_folders:
-				if folder[-1] != os.sep: folder += os.sep
-				files = os.listdir(folder)
-				self.local_files_cache += [folder + f for f in files]
-			if self.verbose >= 3:
-				print("Created file list with", len(self.local_files_cache), "entries")
-			self.local_folders_cache = search_folders
-
-		# Create filename for this mailing
-		date_ = isodate.parse_datetime(m['created_at'])
-		date = date_.strftime('%Y-%m-%d')
-		# ID & Filenames for this mailing
-		code = m['barcode']
-		type_str = '_' + self.TYPE.reverse_mapping[type] if type != self.TYPE.full else ''
+		m = Mailing.of(mailing)
+		# Create index of local files, if needed
+		self.buildLocalIndex(search_folders)
+
+		# Filename for this mailing: <date>_<barcode><_type>.<ext>
+		filename = m.names[type]
 		ext = 'jpg' if (type in [self.TYPE.thumb, self.TYPE.envelope]) else 'pdf'
-		filename = date + '_' + code + type_str + '.' + ext
 
 		# Find locally existing file (or None)
-		# Condition accodring to regexp: *<code><-tags><_type>.<ext>
-		r = re.compile('.*[-_\. ]' + m['barcode'] + "[-A-Z]*" + type_str + '\.' + ext)
-		local_file = list(filter(r.match, self.local_files_cache))
+		# Condition: *<code><-tags><_type>.<ext>
+		local_file = self.localFiles(m.barcode, type, ext)
 		if len(local_file) > 1 and self.verbose >= 2:
 			print("Found multiple identical files:", local_file)
 		local_file = local_file[0] if len(local_file) >= 1 else None
 
 		return (filename, local_file)
 
+	def checkDuplicates(self):
+		"""
+		Print files with identical content in all local folders, see findDuplicates()
+		"""
+		dups = self.findDuplicates(self.folders)
+		for paths in dups:
+			print("Found identical files:")
+			for f in paths: print("  ", f)
+		return dups
+
 	def checkMultiple(self, mailings):
 		"""
 		Check if there are multiple files for one mailing
 		"""
 		# Create file database:
-		self.localFileMailing(mailings[0], self.TYPE.pdf, self.folders)
+		self.buildLocalIndex(self.folders)
 		for m in reversed(mailings):
-			r1 = re.compile('.*[-_\. ]' + m['barcode'] + '.*\.pdf')
-			r2 = re.compile('.*[-_\. ]' + m['barcode'] + '.*\.jpg')
-			local_pdf = list(filter(r1.match, self.local_files_cache))
-			local_jpg = list(filter(r2.match, self.local_files_cache))
+			local_pdf = self.localFiles(m['barcode'], ext='pdf')
+			local_jpg = self.localFiles(m['barcode'], ext='jpg')
 			if len(local_pdf) > 1 or len(local_jpg) > 1:
 				print("Found multiple files for", m['barcode'])
 				for f in local_pdf + local_jpg: print("  ", f)
 
 
+	def setPostproc(self, jobs=1, timeout=None):
+		"""
+		Configure the post-processing stage (combine, tags, postproc.sh)
+		jobs     -- Number of mailings post-processed in parallel. With more than one,
+		            in-process combining runs in worker processes.
+		timeout  -- Timeout in seconds for each postproc.sh call
+		"""
+		self.postproc_jobs = max(1, jobs)
+		self.postproc_timeout = timeout
+
 	def syncMailings(self, mailings, thumbs=False, combine=True):
 		"""
 		Download all missing files (thumbs, envelope, pdf) for the given mailings
-		mailings     -- struct returned from getList()
+		mailings     -- List returned from getList(), or an iterator, e.g. iterLists()
+		A list is planned first (see planSync()) and executed by priority, see
+		prioritize(). Mailings of an iterator (as synced by the command line) are
+		planned and executed as they are listed, i.e. newest first per status.
+		With self.jobs > 1, mailings are downloaded in a thread pool. Downloaded
+		mailings are handed to a separate post-processing pool (combine, tags,
+		postproc.sh), so the network does not wait for them. Post-processing of a
+		mailing starts only after all its downloads are done. The status of mailings
+		without errors is recorded after their post-processing, see statusDelta().
+		Returns list of post-processing failures
+		"""
+		ftypes = self.syncTypes(thumbs)
+		# Build the local file index once, before any worker uses it
+		self.buildLocalIndex(self.folders)
+		self.has_script_post = os.path.isfile(self.script_post)
+		post_futures = []
+		failures = []
+		self.post_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.postproc_jobs)
+		if self.postproc_jobs > 1 and combine:
+			self.combine_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.postproc_jobs)
+		self.failed_mailings = []
+		self.failed_ids = set()
+		self.synced_mailings = []
+		sync_start = time.monotonic()
+		plans = None
+		if self.zip_download:
+			mailings = list(mailings)
+		if isinstance(mailings, list):
+			plans = self.planMailings(mailings, ftypes, combine)
+			mailings = self.prioritize(mailings, plans)
+			if self.zip_download:
+				self.prefetchZip([ a for m in mailings for a in plans[m['id']] ])
+		try:
+			post_futures = self.syncPass(mailings, ftypes, combine, plans=plans)
+			# Drain post-processing queue
+			for fut in post_futures:
+				failures += self.postprocResult(fut)
+			# Retry mailings with failed downloads once, after the files of the first pass are in place
+			retry = self.failed_mailings
+			if len(retry) > 0:
+				if self.verbose >= 1: print ("Retrying %d mailing(s)" % (len(retry)))
+				self.local_index = None
+				self.buildLocalIndex(self.folders)
+				for fut in self.syncPass(retry, ftypes, combine, True):
+					failures += self.postprocResult(fut)
+		finally:
+			self.post_pool.shutdown()
+			self.post_pool = None
+			if self.combine_pool is not None:
+				self.combine_pool.shutdown()
+				self.combine_pool = None
+			self.flushSyncDB()
+			self.prefetched = {}
+			# Only mailings that were completely synced, not those interrupted in between
+			self.writeStatusDB([ m for m in self.synced_mailings if m['id'] not in self.failed_ids ])
+			self.synced_mailings = None
+			self.metrics.addTime('sync', time.monotonic() - sync_start)
+		self.metrics.count('postproc_failures', len(failures))
+		if len(failures) > 0:
+			print ("Post-processing failed for %d file(s):" % (len(failures)))
+			for f in failures: print ("  ", f)
+		return failures
+
+	@staticmethod
+	def postprocResult(fut):
+		"""
+		Failures of a postprocMailing() future. An exception counts as a failure, so that
+		the remaining mailings are still post-processed and reported.
+		"""
+		try:
+			return fut.result()
+		except Exception as e:
+			return [ "post-processing error: %s" % (e) ]
+
+	def syncTypes(self, thumbs=False):
+		"""
+		File types handled by the sync, in the order they are planned
 		"""
-		filename = {}
 		ftypes = [self.TYPE.full, self.TYPE.envelope, self.TYPE.pdf]
 		if thumbs:
 			ftypes.append(self.TYPE.thumb)
-		for m in reversed(mailings):
-			# TODO: Code may have errors, e.g. if some files already exist
-			exists = [False] * len(self.TYPE.reverse_mapping)
-			for f in ftypes:
-				stored = False
-				# Check for local file
-				(file_org, local_file) = self.localFileMailing(m, f, self.folders)
-				filename[f] = file_org if local_file is None else local_file
-
-				if f == self.TYPE.full and local_file is not None:
-					exists[self.TYPE.full] = local_file
-				# Perform download, if required:
-				if not exists[self.TYPE.full] and f != self.TYPE.full and \
-					local_file is None and \
-					not file_org in self.syncdb:
-					stored = self.downloadMailing(m, f, filename[f])
-					if stored:
-						self.writeSyncDB(file_org)
-						filename[f] = stored
-						print ("Mailing stored to", filename[f])
-					elif stored is False:
-						#if self.verbose >= 0:
-						print ("Mailing failed to download:", filename[f])
-						continue
-					elif stored is None:
-						pass
-				else:
-					if self.verbose >= 3:
-						print ("File", filename[f], "not required/already exists")
-				exists[f] = os.path.isfile(filename[f])
-
-				# Combine envelope & mailing into one file
-				if f == self.TYPE.pdf and combine and not exists[self.TYPE.full] and exists[self.TYPE.envelope] and exists[self.TYPE.pdf]:
-					r = self.combineFiles(filename[self.TYPE.envelope], filename[self.TYPE.pdf])
-					if r:
-						filename[self.TYPE.full] = r
-						r_ren = self.writeTag(m, r)
-						filename[self.TYPE.full] = r_ren if r_ren else r
-						print ("Mailing combined to", r)
-					else:
-						print ("Failed: Combining mailing")
+		return ftypes
+
+	@staticmethod
+	def iterCollect(items, collected):
+		"""
+		Pass through items, appending each to the list collected
+		"""
+		for i in items:
+			collected.append(i)
+			yield i
+
+	def syncPass(self, mailings, ftypes, combine, retry=False, plans=None):
+		"""
+		Run syncMailing() for all mailings, in a thread pool if self.jobs > 1.
+		Network and file errors fail only the mailing; other exceptions abort the sync.
+		plans  -- Dict mailing ID -> actions of planMailing(), to execute instead of planning again
+		Returns list of post-processing futures
+		"""
+		def sync(m):
+			if plans is not None and m['id'] in plans:
+				return self.executeMailing(m, plans[m['id']], retry)
+			return self.syncMailing(m, ftypes, combine, retry)
+		post_futures = []
+		if self.jobs <= 1:
+			for m in mailings:
+				try:
+					post_futures.append(sync(m))
+				except (requests.exceptions.RequestException, OSError) as e:
+					print ("Mailing failed to sync:", e)
+					self.sync_errors += 1
+					self.failed_ids.add(m['id'])
+			return post_futures
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+			futures = { pool.submit(sync, m): m for m in mailings }
+			for fut in concurrent.futures.as_completed(futures):
+				try:
+					post_futures.append(fut.result())
+				except (requests.exceptions.RequestException, OSError) as e:
+					print ("Mailing failed to sync:", e)
+					self.sync_errors += 1
+					self.failed_ids.add(futures[fut]['id'])
+		return post_futures
+
+	def syncMailing(self, m, ftypes, combine=True, retry=False):
+		"""
+		Plan and execute the sync of a single mailing, see planMailing() and executeMailing()
+		Returns the future of postprocMailing()
+		"""
+		return self.executeMailing(m, self.planMailing(m, ftypes, combine), retry)
+
+	def planSync(self, mailings, thumbs=False, combine=True):
+		"""
+		Actions to sync the given mailings, without executing them (e.g. for a dry run),
+		in the order syncMailings() would execute them. See planMailing().
+		Returns list of actions (JSON serializable dicts)
+		"""
+		self.buildLocalIndex(self.folders)
+		self.has_script_post = os.path.isfile(self.script_post)
+		mailings = list(mailings)
+		plans = self.planMailings(mailings, self.syncTypes(thumbs), combine)
+		return [ a for m in self.prioritize(mailings, plans) for a in plans[m['id']] ]
+
+	def planMailings(self, mailings, ftypes, combine=True):
+		"""
+		Dict mailing ID -> actions of planMailing()
+		"""
+		return { m['id']: self.planMailing(m, ftypes, combine) for m in mailings }
+
+	def prioritize(self, mailings, plans):
+		"""
+		Execution order of planned mailings: mailings with a PDF to download first,
+		then other downloads, then mailings with local work only; newest first in each group.
+		Only used for lists (planSync(), --watch, --verify); -s streams the status lists
+		and executes in listing order
+		"""
+		def priority(m):
+			types = [ a['type'] for a in plans[m['id']] if a['action'] == 'download' ]
+			group = 0 if 'pdf' in types else 1 if len(types) > 0 else 2
+			return (group, -Mailing.of(m).created.timestamp())
+		return sorted(mailings, key=priority)
+
+	def planMailing(self, mailing, ftypes, combine=True):
+		"""
+		Decide what to do for a mailing, based on the local file index and the sync DB,
+		without changing anything. Actions, in the order they are executed:
+		  download  -- Download a file (type, name: original filename, file: target path)
+		  thumb     -- Create the thumb from the envelope (name, source)
+		  combine   -- Combine envelope and PDF (envelope, pdf, file)
+		  tag       -- Rename a file to include the status tags (type, file, to)
+		  postproc  -- Run postproc.sh on the new file (type)
+		Returns list of actions (JSON serializable dicts)
+		"""
+		m = Mailing.of(mailing)
+		actions = []
+		def action(kind, **kw):
+			a = { 'action': kind, 'mailing': m.id, 'barcode': m.barcode }
+			a.update(kw)
+			actions.append(a)
+			return a
+		files = {}
+		downloads = []
+		thumb = None
+		local_full = None
+		for f in ftypes:
+			(file_org, local_file) = self.localFileMailing(m, f, self.folders)
+			if f == self.TYPE.full:
+				local_full = local_file
+			if local_file is not None:
+				files[f] = local_file
+			elif local_full is None and f != self.TYPE.full and file_org not in self.syncdb:
+				if f == self.TYPE.thumb and self.TYPE.envelope in files and self.canDeriveThumb():
+					# Created from the envelope in postprocMailing(), no download
+					thumb = file_org
+				elif self.mailingUrl(m, f) is not None:
+					files[f] = self.mailingTarget(m, file_org)
+					downloads.append(f)
+					action('download', type=self.TYPE.reverse_mapping[f], name=file_org, file=files[f])
+			elif self.verbose >= 3:
+				print ("File", local_file or file_org, "not required/already exists")
+		if thumb is not None:
+			action('thumb', name=thumb, source=files[self.TYPE.envelope])
+			files[self.TYPE.thumb] = os.path.join(os.path.dirname(files[self.TYPE.envelope]), thumb)
+		# Tags: all files, except envelope and PDF which are removed by combining
+		tag_types = [ f for f in ftypes if f in files ]
+		if combine and local_full is None and self.TYPE.envelope in files and self.TYPE.pdf in files:
+			files[self.TYPE.full] = files[self.TYPE.pdf].replace('_pdf', '')
+			action('combine', envelope=files[self.TYPE.envelope], pdf=files[self.TYPE.pdf], file=files[self.TYPE.full])
+			tag_types = [ f for f in tag_types if f not in (self.TYPE.envelope, self.TYPE.pdf) ] + [self.TYPE.full]
+		for f in tag_types:
+			to = self.taggedName(m, files[f])
+			if to is not None:
+				action('tag', type=self.TYPE.reverse_mapping[f], file=files[f], to=to)
+		if self.has_script_post is None:
+			self.has_script_post = os.path.isfile(self.script_post)
+		if self.has_script_post and self.TYPE.pdf in downloads:
+			action('postproc', type='full' if combine else 'pdf')
+		return actions
+
+	def executeMailing(self, m, actions, retry=False):
+		"""
+		Execute the downloads planned for a mailing and queue the other actions for
+		post-processing. Mailings with failed downloads are collected in
+		self.failed_mailings, unless this already is the retry. During syncMailings(),
+		mailings without errors are added to self.synced_mailings once their
+		post-processing is done.
+		Returns the future of postprocMailing()
+		"""
+		failed = False
+		files = {}
+		for a in actions:
+			if a['action'] != 'download':
+				continue
+			f = getattr(self.TYPE, a['type'])
+			stored = self.downloadMailing(m, f, a['name'])
+			if stored:
+				self.metrics.count('files_downloaded')
+				self.writeSyncDB(a['name'], m, stored)
+				files[f] = stored
+				print ("Mailing stored to", stored)
+			elif stored is False:
+				print ("Mailing failed to download:", a['file'])
+				failed = True
+		if len(files) > 0:
+			self.metrics.count('mailings_downloaded')
+		elif not failed:
+			self.metrics.count('mailings_skipped')
+		if failed:
+			if retry:
+				self.sync_errors += 1
+				self.failed_ids.add(m['id'])
+			else:
+				self.failed_mailings.append(m)
+		if self.post_pool is not None:
+			fut = self.post_pool.submit(self.postprocMailing, m, actions, files)
+		else:
+			# Called outside of syncMailings(): post-process right away
+			fut = concurrent.futures.Future()
+			try:
+				fut.set_result(self.postprocMailing(m, actions, files))
+			except Exception as e:
+				fut.set_exception(e)
+		def done(f):
+			if f.exception() or f.result():
+				# Failed post-processing (e.g. combining) is retried in the next sync
+				self.failed_ids.add(m['id'])
+			elif not failed and self.synced_mailings is not None:
+				self.synced_mailings.append(m)
+		fut.add_done_callback(done)
+		return fut
 
+	def postprocMailing(self, m, actions, downloaded):
+		"""
+		Post-processing of one mailing after its downloads: create the thumb, combine
+		envelope and PDF, rename files to include tags, run postproc.sh
+		actions     -- Actions of planMailing()
+		downloaded  -- Dict type -> path of the files downloaded by executeMailing()
+		Returns list of failures
+		"""
+		failures = []
+		# Current path per type name; files that failed to download are missing
+		files = {}
+		for a in actions:
+			if a['action'] == 'download':
+				f = getattr(self.TYPE, a['type'])
+				if f in downloaded:
+					files[a['type']] = downloaded[f]
+			elif a['action'] == 'tag':
+				files.setdefault(a['type'], a['file'])
+			elif a['action'] == 'thumb':
+				files.setdefault('envelope', a['source'])
+		for a in actions:
+			if a['action'] == 'thumb':
+				# Before combining, which removes the envelope
+				source = files.get('envelope')
+				r = self.deriveThumb(source, a['name'], m) if source and os.path.isfile(source) else None
+				if r:
+					files['thumb'] = r
+					print ("Thumb created:", r)
+				else:
+					failures.append("thumb: " + str(source))
+			elif a['action'] == 'combine':
+				(envelope, pdf) = (files.get('envelope', a['envelope']), files.get('pdf', a['pdf']))
+				if not (os.path.isfile(envelope) and os.path.isfile(pdf)):
+					continue
+				r = self.combineFiles(envelope, pdf)
+				if r:
+					self.writeSyncDB(os.path.basename(r), m, r)
+					files['full'] = r
+					print ("Mailing combined to", r)
+				else:
+					print ("Failed: Combining mailing")
+					failures.append("combine: " + pdf)
+			elif a['action'] == 'tag':
 				# Rename files to include current labels
-				ren = self.writeTag(m, filename[f])
+				ren = self.writeTag(m, files.get(a['type']))
 				if ren:
-					filename[f] = ren
-
-				# Postproc script
-				script_post = os.path.dirname(os.path.realpath(__file__)) + '/postproc.sh'
-				if os.path.isfile(script_post) and f == self.TYPE.pdf and stored:
-					fn = filename[self.TYPE.full] if combine else filename[self.TYPE.pdf]
-					print(fn)
+					files[a['type']] = ren
+			elif a['action'] == 'postproc' and self.TYPE.pdf in downloaded:
+				fn = files.get(a['type'])
+				print(fn)
+				if fn is not None and os.path.isfile(fn):
+					try:
+						with self.metrics.timer('postproc'):
+							run = subprocess.run([self.script_post, fn], timeout=self.postproc_timeout) #, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+						if run.returncode != 0:
+							failures.append("postproc.sh exit code %d: %s" % (run.returncode, fn))
+					except subprocess.TimeoutExpired:
+						failures.append("postproc.sh timeout: " + fn)
+					self.snapshotInvalidate(fn)
+					# postproc.sh may change the file in place (e.g. OCR): record its new size and hash
 					if os.path.isfile(fn):
-						run = subprocess.run([script_post, fn]) #, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-						#res = run.stdout.decode('utf-8')
-						# TODO: Should store new filename to filename, but not really needed any more 
+						self.writeSyncDB(Mailing.of(m).names[getattr(self.TYPE, a['type'])], m, fn)
+					#res = run.stdout.decode('utf-8')
+					# TODO: Should store new filename to filename, but not really needed any more
+		return failures
+
+
+	def canDeriveThumb(self):
+		"""
+		True if thumbs are created locally from the envelope (requires Pillow)
+		"""
+		return self.thumbs_local and Image is not None
 
+	def deriveThumb(self, source, filename, mailing=None):
+		"""
+		Create a thumb from an envelope JPG or combined PDF, next to source, see makeThumb().
+		Runs in self.combine_pool, if set.
+		source    -- Envelope JPG or combined PDF
+		filename  -- Filename of the thumb, as created by localFileMailing()
+		Returns path of the thumb, or None on error
+		"""
+		file_thumb = os.path.join(os.path.dirname(source), filename)
+		try:
+			with self.metrics.timer('thumb'):
+				if self.combine_pool is not None:
+					r = self.combine_pool.submit(makeThumb, source, file_thumb, self.THUMB_SIZE).result()
+				else:
+					r = makeThumb(source, file_thumb, self.THUMB_SIZE)
+		except Exception as e:
+			if self.verbose >= 1: print ("Creating thumb failed:", source, e)
+			return None
+		if r is None:
+			return None
+		self.metrics.count('thumbs_created')
+		self.snapshotUpdate(r)
+		self.writeSyncDB(filename, mailing, r)
+		return r
+
+	def backfillThumbs(self):
+		"""
+		Create missing thumbs in the local folders from envelope JPGs, or from combined
+		PDFs with an embedded JPEG envelope, in parallel worker processes
+		(self.postproc_jobs, or one per core). No network access.
+		Returns number of created thumbs
+		"""
+		self.buildLocalIndex(self.folders)
+		have_thumb = set()
+		sources = {}
+		for path in set(self.local_files_cache):
+			name = os.path.basename(path)
+			(barcode, type) = self.parseSyncName(name)
+			if barcode is None or path.endswith('.part'):
+				continue
+			if type == 'thumb':
+				have_thumb.add(barcode)
+			elif type == 'envelope' or (type == 'full' and pypdf is not None and name.endswith('.pdf')):
+				# Prefer the envelope JPG over the PDF
+				if barcode not in sources or type == 'envelope':
+					sources[barcode] = path
+		jobs = { b: p for (b, p) in sources.items() if b not in have_thumb }
+		if self.verbose >= 1: print ("Creating %d thumb(s)" % (len(jobs)))
+		count = 0
+		with concurrent.futures.ProcessPoolExecutor(max_workers=self.postproc_jobs if self.postproc_jobs > 1 else None) as pool:
+			futures = {}
+			for (barcode, path) in jobs.items():
+				# <date>_<barcode><-tags>_envelope.jpg / .pdf -> <date>_<barcode><-tags>_thumb.jpg
+				file_thumb = re.sub(r'(_envelope\.jpg|\.pdf)$', '_thumb.jpg', path)
+				futures[pool.submit(makeThumb, path, file_thumb, self.THUMB_SIZE)] = (barcode, path)
+			for fut in concurrent.futures.as_completed(futures):
+				(barcode, path) = futures[fut]
+				try:
+					r = fut.result()
+				except Exception as e:
+					print ("Creating thumb failed:", path, e)
+					continue
+				if r is None:
+					if self.verbose >= 2: print ("No JPEG envelope in", path)
+					continue
+				count += 1
+				self.snapshotUpdate(r)
+				self.writeSyncDB(self.RE_DATE.match(os.path.basename(path)).group(1) + '_' + barcode + '_thumb.jpg', None, r)
+				if self.verbose >= 2: print ("Thumb created:", r)
+		self.flushSyncDB()
+		self.metrics.count('thumbs_created', count)
+		return count
+
+	def taggedName(self, mailing, local_file):
+		"""
+		Filename including the tags for deleted/forwarded status, or None if unchanged
+		"""
+		mailing = Mailing.of(mailing)
+		tag = mailing.tag
+		if not tag or local_file is None:
+			return None
+		# Scan filename for <barcode>-<tags>
+		m = mailing.tagPattern().match(local_file)
+		if not (m and (m.group(1) or m.group(3))):
+			return None
+		file_tag = m.group(2) if m.group(2) is not None else '-'
+		if not tag in file_tag:
+			file_tag += tag
+		if 'F' in file_tag and 'R' in file_tag:
+			file_tag = file_tag.replace('R', '')
+		if m.group(2):
+			pos = m.span(2)
+			local_file_new = local_file[:pos[0]] + file_tag + local_file[pos[1]:]
+		else:
+			pos = m.span(0)[1]
+			local_file_new = local_file[:pos] + file_tag + local_file[pos:]
+		return local_file_new if local_file_new != local_file else None
 
 	def writeTag(self, mailing, local_file):
 		"""
-		Adds tags to filename (by renaming) for deleted/forwarded status
+		Adds tags to filename (by renaming) for deleted/forwarded status, see taggedName()
 		"""
 		if local_file is None or not os.path.isfile(local_file):
-			return
-		tag = ''
-		if mailing['status'] == 'forwarded': tag = 'F'
-		if mailing['status'] == 'forward_requested': tag = 'R'
-		if mailing['status'] == 'destroyed': tag = 'D'
-		if mailing['status'] == 'destroy_requested': tag = 'D'
-		# Scan filename for <barcode>-<tags>
-		b = mailing['barcode']
-		m = re.match(".*("+b+")(-[A-Z]*)|.*("+b+")", local_file)
-		if tag and (m.group(1) or m.group(3)):
-			file_tag = m.group(2) if m.group(2) is not None else '-'
-			if not tag in file_tag:
-				file_tag += tag
-			if 'F' in file_tag and 'R' in file_tag:
-				file_tag = file_tag.replace('R', '')
-			if m.group(2):
-				pos = m.span(2)
-				local_file_new = local_file[:pos[0]] + file_tag + local_file[pos[1]:]
-			else:
-				pos = m.span(0)[1]
-				local_file_new = local_file[:pos] + file_tag + local_file[pos:]
-
-			if local_file_new != local_file:
-				if not os.path.isfile(local_file_new):
-					os.rename(local_file, local_file_new)
-					if self.verbose >= 1 or True:
-						print("New Tags, renamed from:", local_file, "to:", local_file_new)
-					return local_file_new
-				else:
-					if self.verbose >= 1:
-						print("Renamed failed, file exists:", local_file_new)
+			return None
+		local_file_new = self.taggedName(mailing, local_file)
+		if local_file_new is None:
+			return None
+		if not os.path.isfile(local_file_new):
+			os.rename(local_file, local_file_new)
+			self.snapshotUpdate(local_file, False)
+			self.snapshotUpdate(local_file_new)
+			self.moveSyncDB(local_file, local_file_new)
+			if self.verbose >= 1 or True:
+				print("New Tags, renamed from:", local_file, "to:", local_file_new)
+			return local_file_new
+		else:
+			if self.verbose >= 1:
+				print("Renamed failed, file exists:", local_file_new)
 		return None
 
 
@@ -495,27 +2712,49 @@ if __name__ == '__main__':
 	# group = parser.add_usage_group(kind='any', required=True) # http://stackoverflow.com/questions/6722936
 	parser.add_argument('-t', action='store_true', help='MODE: Run demo/test (login, list mailings, download)')
 	parser.add_argument('-s', '--sync', action='store_true', help='MODE: One-way sync: Download missing files of all mailings to current folder')
+	parser.add_argument('--watch', action='store_true', help='MODE: Keep running and sync new or changed mailings (stop with SIGTERM)')
+	parser.add_argument('--interval', type=float, default=60, help='Watch mode: poll interval after new mail, in seconds (default 60)')
+	parser.add_argument('--max-interval', type=float, default=3600, help='Watch mode: maximum poll interval while idle, in seconds (default 3600)')
+	parser.add_argument('--dry-run', action='store_true', help='Sync mode: Print the planned actions (downloads, combine, renames, forwarding) as JSON instead of executing them')
 	parser.add_argument('--nodb', action='store_true', help='Do not read Sync-DB (existence of local files is always checked)')
+	parser.add_argument('--db-query', help='MODE: Show Sync-DB entries for a barcode or filename pattern (SQL LIKE, e.g. %%2020-01%%)')
+	parser.add_argument('--db-compact', action='store_true', help='MODE: Compact the Sync-DB')
 	parser.add_argument('--batches', action='store_true', help='MODE: List forwarding batches (only unsent)')
-	parser.add_argument('-F', '--forward_mailing', help='MODE: Add the specified mailing slug to the first existing unsent forwarding batch')
+	parser.add_argument('-F', '--forward_mailing', help='MODE: Add the specified mailing ID(s) to the first existing unsent forwarding batch. Comma separated, or @file with one ID per line')
 	parser.add_argument('--forward_dir', action='append', help='Add all mailings in given directory to forwarding batch, if one exists. Must use -s.')
 	parser.add_argument('--forward_older', type=int, default=-1, help='Add all mailings older than given number of days to forwarding batch, if one exists. Must use -s.')
-	parser.add_argument('-c', '--check_multiple', action='store_true', help='MODE: Check if there are multiple files of the same mailing')
+	parser.add_argument('-c', '--check_multiple', action='store_true', help='MODE: Check if there are multiple files of the same mailing, or files with identical content')
+	parser.add_argument('--verify', action='store_true', help='MODE: Verify size and SHA-256 of all files in the Sync-DB, download missing or corrupt files again')
 	parser.add_argument('-u', required=0, help='Dropscan username (may be specified in credentials file)')
 	parser.add_argument('-p', required=0, help='Dropscan password (may be specified in credentials file)')
-	parser.add_argument('--thumbs', action='store_true', help='Also sync thumbs of envelopses')
+	parser.add_argument('--combine', default='auto', choices=['auto', 'python', 'tools'], help='Backend to combine envelope and PDF: python (pypdf), tools (convert, pdftk) or auto (default)')
+	parser.add_argument('--postproc-jobs', type=int, default=1, help='Number of mailings to post-process (combine, postproc.sh) in parallel (default 1)')
+	parser.add_argument('--postproc-timeout', type=float, help='Timeout in seconds for postproc.sh')
+	parser.add_argument('--thumbs', action='store_true', help='Also sync thumbs of envelopses (created from the envelope, if Pillow is installed)')
+	parser.add_argument('--thumbs-download', action='store_true', help='Download thumbs from Dropscan instead of creating them from the envelope')
+	parser.add_argument('--thumbs-backfill', action='store_true', help='MODE: Create missing thumbs from local envelopes and combined PDFs (no network access)')
 	parser.add_argument('-r', '--recursive',  action='store_true', help='Check all subfolders for locally existing files during sync.')
 	parser.add_argument('-d', '--dir',  action='append', help='Additional folder(s) to check for locally existing files during sync.')
+	parser.add_argument('--scanbox', action='append', help='Only list and sync this scanbox ID (may be repeated; default: all scanboxes)')
 	parser.add_argument('--count', type=int, help='Number of list items to request from Dropscan (default 20)')
+	parser.add_argument('--full', action='store_true', help='List all mailings (up to --count) instead of only those newer than the last sync')
+	parser.add_argument('--reconcile', type=float, default=24, help='Do a full listing if the last one is older than given number of hours (default 24)')
+	parser.add_argument('--zip', action='store_true', help='EXPERIMENTAL: Download envelopes and PDFs of new mailings in bulk as ZIP archives. Needs a server with a ZIP endpoint, e.g. dropscan_mock.py; secure.dropscan.de has none')
+	parser.add_argument('--zip-batch', type=int, help='Number of mailings per ZIP archive (default 100)')
+	parser.add_argument('--zip-path', help='URL path of the ZIP endpoint (default /services/mailings/zip)')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of mailings to download in parallel (default 1)')
+	parser.add_argument('--retries', type=int, default=4, help='Retries of failed requests (connection errors, 429, 5xx; default 4)')
+	parser.add_argument('--rate', type=float, default=0, help='Maximum number of requests per second (default: no limit)')
+	parser.add_argument('--bwlimit', type=float, default=0, help='Maximum download bandwidth in KB/s (default: no limit)')
+	parser.add_argument('--relogin', action='store_true', help='Ignore the cached session and login again')
+	parser.add_argument('--session-cache', help='File for the cached session (default: .dropscan-session.json next to this script)')
+	parser.add_argument('--base-url', help='Server URL, e.g. of a local test server (default https://secure.dropscan.de)')
+	parser.add_argument('--metrics', help='Write timing and request metrics of this run as JSON to file (- for stdout)')
+	parser.add_argument('--metrics-prom', help='Write metrics of this run as Prometheus textfile')
 	parser.add_argument('--proxy', help='Use a proxy server to connect to Dropscan')
 	parser.add_argument('-v', default=0, type=int, help='Set Verbosity [0..3]')
 	args = parser.parse_args()
 
-	# Check tools
-	for tool in [ 'convert', 'pdftk' ]:
-		if shutil.which(tool) is None:
-			print("Missing, please install:", tool)
-
 	# Read credentials file
 	user = ''
 	password = ''
@@ -535,12 +2774,27 @@ if __name__ == '__main__':
 	D = Dropscan(user, password, args.v)
 	if args.count:
 		D.setListCount(args.count)
+	D.setCombineBackend(args.combine)
+	D.selectScanboxes(args.scanbox)
+	D.thumbs_local = not args.thumbs_download
+	if args.zip:
+		D.setZipDownload(True, args.zip_batch, args.zip_path)
+	D.setRetry(retries=args.retries, rate=args.rate)
+	D.setBandwidth(args.bwlimit * 1024)
+	D.setPostproc(args.postproc_jobs, args.postproc_timeout)
+	if args.jobs > 1:
+		D.setJobs(args.jobs)
 	if args.proxy:
 		D.setProxy(args.proxy)
+	if args.base_url:
+		D.setBaseUrl(args.base_url)
+	D.setSessionCache(args.session_cache or os.path.dirname(os.path.realpath(__file__)) + '/.dropscan-session.json')
+	if args.relogin and os.path.exists(D.session_cache):
+		os.remove(D.session_cache)
 	# Search folders
 	folders = []
 	if args.recursive:
-		folders = [d[0] for d in os.walk('.')]
+		folders = D.walkFolders('.')
 	if args.dir:
 		folders += args.dir
 	if args.forward_dir:
@@ -550,6 +2804,7 @@ if __name__ == '__main__':
 			else:
 				folders += [d]
 	D.setLocalFolders(folders)
+	exit_code = 0
 
 	# Test/demo
 	if args.t:
@@ -559,37 +2814,94 @@ if __name__ == '__main__':
 	elif args.sync:
 		if not args.nodb:
 			D.readSyncDB()
-		# Do main Sync
-		D.login()
-		l1 = D.getList(D.FILTER.scanned)
-		l2 = D.getList(D.FILTER.received)
-		l3 = D.getList(D.FILTER.forwarded)
-		l4 = D.getList(D.FILTER.destroyed)
-		D.syncMailings(l4+l3+l2+l1, args.thumbs)
-		#D.syncMailings(l2, args.thumbs)
-		#D.syncMailings(l1, args.thumbs)
-
-		# Auto-add mailings in folder to forward batch
-		if args.forward_dir:
-			D.addFolderstoBatch(l1+l2, args.forward_dir)
-		if args.forward_older > -1:
-			D.addOldtoBatch(l1+l2, args.forward_older)
+			D.readStatusDB()
+		# Incremental listing, unless forwarding needs all mailings or reconciliation is due
+		D.readWatermarks()
+		full = args.full or args.forward_dir or args.forward_older > -1 or D.needsFullListing(args.reconcile)
+		if args.v >= 2: print ("Listing:", "full" if full else "incremental")
+		# Do main Sync: downloads start while the lists of all statuses are fetched;
+		# only new mailings and those with changed status are synced
+		D.loginCached()
+		listed = []
+		mailings = D.iterDelta(D.iterCollect(D.iterLists(None, not full), listed))
+		if args.dry_run:
+			# Plan only: no downloads, renames, forwarding, watermarks or status updates
+			actions = D.planSync(mailings, args.thumbs)
+			if args.forward_dir or args.forward_older > -1:
+				actions += D.planForward(listed, args.forward_dir, args.forward_older if args.forward_older > -1 else None)
+			print (json.dumps(actions, indent=2))
+		else:
+			D.syncMailings(mailings, args.thumbs)
+			# Keep the old watermarks while mailings failed, incl. their post-processing,
+			# so that the next incremental listing includes them again
+			if D.sync_errors == 0 and len(D.failed_ids) == 0:
+				D.writeWatermarks(full)
+
+			# Auto-add mailings in folder to forward batch (only scanned and received ones)
+			if args.forward_dir:
+				D.addFolderstoBatch(listed, args.forward_dir)
+			if args.forward_older > -1:
+				D.addOldtoBatch(listed, args.forward_older)
+
+
+	# Watch/daemon mode
+	elif args.watch:
+		if not args.nodb:
+			D.readSyncDB()
+			D.readStatusDB()
+		D.loginCached()
+		signal.signal(signal.SIGTERM, lambda signum, frame: D.stop())
+		signal.signal(signal.SIGINT, lambda signum, frame: D.stop())
+		D.watch(args.thumbs, args.interval, args.max_interval)
 
+	# Verify files of the Sync-DB, re-download missing and corrupt ones
+	elif args.verify:
+		D.readSyncDB()
+		# Sync again into the folders of the recorded files, e.g. <scanbox>/<recipient>
+		folders = D.recordedFolders()
+		bad = D.verifySyncDB()
+		for (row, state) in bad:
+			print ("%s: %s" % (state.capitalize(), row['path'] or row['name']))
+		barcodes = set(row['barcode'] for (row, state) in bad if state != 'modified')
+		if len(barcodes) > 0:
+			if not args.count:
+				D.setListCount(1000)
+			D.setLocalFolders(folders)
+			try:
+				D.loginCached()
+				D.syncMailings([ m for m in D.iterLists() if m['barcode'] in barcodes ], args.thumbs)
+			finally:
+				kept = D.replaceCorrupt(bad)
+			for f in kept:
+				print ("Not replaced, corrupt file kept as:", f)
+			if len(kept) > 0 or D.sync_errors > 0:
+				exit_code = 1
+
+	# Create thumbs for the local archive
+	elif args.thumbs_backfill:
+		if Image is None:
+			print("Missing, please install: Pillow")
+		else:
+			D.backfillThumbs()
 
 	# Check for multiple files:
 	elif args.check_multiple:
+		D.checkDuplicates()
 		if not args.count:
 			D.setListCount(1000)
-			D.login()
-			l1 = D.getList(D.FILTER.scanned)
-			l2 = D.getList(D.FILTER.received)
-			l3 = D.getList(D.FILTER.forwarded)
-			l4 = D.getList(D.FILTER.destroyed)
-			D.checkMultiple(l4+l3+l2+l1)
+			D.loginCached()
+			D.checkMultiple(list(D.iterLists()))
+
+	# Sync-DB maintenance
+	elif args.db_query:
+		for row in D.querySyncDB(args.db_query):
+			print ("\t".join([ str(row[k]) for k in ['name', 'size', 'sha256', 'status', 'downloaded_at'] ]))
+	elif args.db_compact:
+		D.compactSyncDB()
 
 	# List unsent forwarding batches
 	elif args.batches:
-		D.login()
+		D.loginCached()
 		l = D.getBatches()
 		print(json.dumps(l, sort_keys=True, indent=2))
 		if len(l) == 0:
@@ -597,9 +2909,29 @@ if __name__ == '__main__':
 
 	# Add mailing to forwarding batch
 	elif args.forward_mailing:
-		D.login()
-		res = D.addMailingtoBatch(args.forward_mailing)
-		print ("Result:", res)
+		# Comma separated IDs, or @file with one ID per line
+		if args.forward_mailing.startswith('@'):
+			with open(args.forward_mailing[1:]) as f:
+				ids = [ l.split('#')[0].strip() for l in f ]
+		else:
+			ids = re.split(r'[,\s]+', args.forward_mailing)
+		ids = [ i for i in ids if i ]
+		D.loginCached()
+		results = D.forwardMailings([ { 'id': i } for i in ids ])
+		for (id, res) in results.items():
+			print ("Result:", id, res)
 
 	else:
 		parser.print_help()
+
+	D.writeSnapshot()
+
+	# Metrics of this run
+	if args.metrics == '-':
+		print(D.metrics.toJSON())
+	elif args.metrics:
+		with open(args.metrics, 'w') as f:
+			f.write(D.metrics.toJSON())
+	if args.metrics_prom:
+		D.metrics.writePrometheus(args.metrics_prom)
+	sys.exit(exit_code)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Asyncio variant of the Dropscan client, based on aiohttp.
+Filenames, URLs, scanbox selection and the retry policy are shared with the
+Dropscan class through DropscanClient; the network methods are coroutines.
+INSTALL: pip install aiohttp
+"""
+
+import asyncio
+import os.path
+import time
+import aiohttp
+
+from dropscan import DropscanClient, Mailing, AuthError, CircuitOpenError
+
+
+def syncFile(fd):
+	"""
+	Flush fd and sync it to disk
+	"""
+	fd.flush()
+	os.fsync(fd.fileno())
+
+
+class AsyncDropscan(DropscanClient):
+	"""
+	Usage:
+		async with AsyncDropscan(user, password) as D:
+			await D.login()
+			mailings = await D.getList(D.FILTER.scanned)
+	"""
+	limit = 4
+
+	def __init__(self, user, password, verbose=0, limit=4):
+		"""
+		limit -- Maximum number of concurrent HTTP requests (and pooled connections)
+		"""
+		super().__init__(user, password, verbose)
+		self.limit = limit
+		self.client = None
+		self.semaphore = None
+		self.login_async_lock = None
+
+	async def open(self):
+		if self.client is None:
+			connector = aiohttp.TCPConnector(limit=self.limit)
+			# unsafe: also keep cookies of IP hosts, e.g. a local test server
+			self.client = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True))
+			self.semaphore = asyncio.Semaphore(self.limit)
+			self.login_async_lock = asyncio.Lock()
+		return self
+
+	async def close(self):
+		if self.client is not None:
+			await self.client.close()
+			self.client = None
+
+	async def __aenter__(self):
+		return await self.open()
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def login(self):
+		""" Login to dropscan.de. Saves cookie and the scanbox ID as class variables. """
+		await self.open()
+		if self.verbose >= 3: print ("--- Pre-Login ---")
+		r = await self.httpRequest('get', self.BASE_URL + '/login')
+		try:
+			auth = self.loginForm(await r.read())
+		finally:
+			r.release()
+		if self.verbose >= 3: print ("--- Login ---")
+		r = await self.httpRequest('post', self.BASE_URL + '/login', data=auth, allow_redirects=True)
+		r.release()
+		if self.verbose >= 3: print ("Status code: ", r.status, "\nURL: ", r.url)
+		self.checkLogin(r.url)
+		self.login_count += 1
+		# No relogin on failure: login_async_lock may be held by the caller
+		await self.getScanboxes(relogin=False)
+		return True
+
+	async def apiRequest(self, method, url, relogin=True, **kwargs):
+		"""
+		HTTP request, see httpRequest(). On an authentication failure, login() is
+		called once and the request repeated.
+		relogin -- False to raise on an authentication failure instead (used within login())
+		Returns the aiohttp response; the caller has to release() it.
+		"""
+		await self.open()
+		count = self.login_count
+		r = await self.httpRequest(method, url, **kwargs)
+		if not self.isAuthFailure(r):
+			return r
+		r.release()
+		if not relogin:
+			raise AuthError("Authentication failed: " + url)
+		async with self.login_async_lock:
+			if count == self.login_count:
+				if self.verbose >= 1: print ("Session expired, logging in")
+				await self.login()
+		r = await self.httpRequest(method, url, **kwargs)
+		if self.isAuthFailure(r):
+			r.release()
+			raise AuthError("Authentication failed after login: " + url)
+		return r
+
+	async def httpRequest(self, method, url, **kwargs):
+		"""
+		HTTP request limited to self.limit concurrent requests, with the rate limit,
+		retries and circuit breaker of Dropscan.httpRequest
+		"""
+		endpoint = kwargs.pop('endpoint', None) or self.endpointName(url)
+		attempt = 0
+		while True:
+			self.breaker.check()
+			await asyncio.sleep(self.rate_limiter.reserve())
+			start = time.monotonic()
+			try:
+				async with self.semaphore:
+					r = await self.client.request(method, url, **kwargs)
+			except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+				self.metrics.request(endpoint, None, time.monotonic() - start)
+				self.breaker.failure()
+				if attempt >= self.retries:
+					raise
+				delay = self.retryDelay(attempt)
+				if self.verbose >= 2: print ("Request failed (%s), retry in %.1f s: %s" % (e, delay, url))
+			else:
+				self.metrics.request(endpoint, r.status, time.monotonic() - start, r.content_length or 0)
+				if not self.isRetryable(method, r.status):
+					if r.status < 500: self.breaker.success()
+					else: self.breaker.failure()
+					return r
+				self.breaker.failure()
+				if attempt >= self.retries:
+					return r
+				delay = self.retryDelay(attempt, r.headers.get('Retry-After'))
+				if self.verbose >= 2: print ("HTTP %d, retry in %.1f s: %s" % (r.status, delay, url))
+				r.release()
+			attempt += 1
+			await asyncio.sleep(delay)
+
+	def isAuthFailure(self, r):
+		return r.status in (401, 403) or str(r.url.path).endswith('/login')
+
+	async def getJSON(self, url, relogin=True):
+		r = await self.apiRequest('get', url, relogin=relogin)
+		try:
+			return await r.json(content_type=None)
+		finally:
+			r.release()
+
+	async def getScanboxes(self, relogin=True):
+		"""
+		Get info about scanboxes, sets self.scanbox
+		relogin -- Login again if the session expired, see apiRequest()
+		"""
+		self.setScanboxes(await self.getJSON(self.BASE_URL + '/services/scanboxes', relogin))
+
+	async def getList(self, filter, scanbox=None):
+		"""
+		List of (at most list_count) mailings in specified box, for all selected
+		scanboxes concurrently unless scanbox is given
+		filter -- Use self.FILTER enum
+		"""
+		if scanbox is None and len(self.scanbox_ids) > 1:
+			lists = await asyncio.gather(*[ self.getList(filter, sb) for sb in self.scanbox_ids ])
+			return [ m for l in lists for m in l ]
+		mailings = []
+		async for m in self.iterList(filter, scanbox):
+			mailings.append(m)
+			if len(mailings) >= self.list_count:
+				break
+		if self.verbose >= 3:
+			print("--- getList", self.FILTER.reverse_mapping[filter], len(mailings), " mailings ---")
+		return mailings
+
+	async def iterList(self, filter, scanbox=None):
+		"""
+		Iterate over all mailings in specified box, newest first, one page at a time
+		"""
+		filter_str = self.FILTER.reverse_mapping[filter]
+		scanbox = scanbox or self.scanbox
+		page_size = min(self.list_count, self.PAGE_SIZE)
+		page = 0
+		while True:
+			mailings = await self.getJSON(self.listUrl(filter_str, page_size, page, scanbox))
+			for m in mailings:
+				yield Mailing(m, scanbox)
+			if len(mailings) < page_size:
+				return
+			page += 1
+
+	async def getBatches(self, only_unsent=True):
+		"""
+		Get list of all forwarding batches
+		"""
+		return self.filterBatches(await self.getJSON(self.batchesUrl()), only_unsent)
+
+	async def addMailingtoBatch(self, mailing, batch=None):
+		"""
+		Adds a mailing to an existing forwarding batch, see Dropscan.addMailingtoBatch
+		Returns: added, alreadyin, nobatch, error
+		"""
+		if batch is None:
+			batches = await self.getBatches()
+			if len(batches) == 0:
+				if self.verbose >= 1: print ("No unsent batch available")
+				return "nobatch"
+			batch = batches[0]
+		if self.isInBatch(mailing, batch):
+			return "alreadyin"
+		r = await self.apiRequest('post', self.forwardUrl(mailing), json={ "forwarding_batch_id": batch['id'] })
+		r.release()
+		ok = r.status == 200
+		if not ok and self.verbose >= 1:
+			print ("Failed to add mailing", mailing['id'], "to batch")
+		return "added" if ok else "error"
+
+	async def downloadMailing(self, mailing, type, filename="", stream=False):
+		"""
+		Download thumb, envelope (JPG) or PDF for a mailing, see Dropscan.downloadMailing
+		stream -- Without filename: return an async iterator of chunks instead of bytes
+		Returns: Filename (written to file), Contents, False (error), None (nothing to download)
+		"""
+		m = mailing
+		url = self.mailingUrl(m, type)
+		if url is None:
+			return None
+		if self.verbose >= 3: print ("--- Download mailing %s (%s) ---" % (m['barcode'], self.TYPE.reverse_mapping[type]))
+		filename = self.mailingTarget(m, filename)
+		if len(filename) > 0:
+			return await self.downloadFile(url, filename)
+		r = await self.apiRequest('get', url, ssl=False)
+		if r.status != 200:
+			if self.verbose >= 2:
+				print("Invalid HTTP status code", r.status, "on URL", url)
+			r.release()
+			return False
+		if stream:
+			return self.iterChunks(r)
+		try:
+			return await r.read()
+		finally:
+			r.release()
+
+	async def iterChunks(self, r):
+		try:
+			async for chunk in r.content.iter_chunked(self.CHUNK_SIZE):
+				yield chunk
+		finally:
+			r.release()
+
+	async def downloadFile(self, url, filename):
+		"""
+		Stream URL to <filename>.part and rename it when complete, see Dropscan.downloadFile
+		and resumeAction().
+		File operations run in worker threads, so they do not block the event loop.
+		Returns: filename, or False on error
+		"""
+		tmp = filename + '.part'
+		offset = os.path.getsize(tmp) if os.path.isfile(tmp) else 0
+		headers = { 'Range': 'bytes=%d-' % (offset) } if offset > 0 else {}
+		try:
+			r = await self.apiRequest('get', url, ssl=False, headers=headers)
+		except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+			if self.verbose >= 2: print ("Download failed:", filename, e)
+			return False
+		try:
+			action = self.resumeAction(url, r.status, r.headers.get('Content-Range'), offset)
+			if action == 'restart':
+				await asyncio.to_thread(os.remove, tmp)
+				r.release()
+				return await self.downloadFile(url, filename)
+			if action is None:
+				return False
+			if action == 'append' and self.verbose >= 2: print ("Resuming download of", filename, "at", offset)
+			fd = await asyncio.to_thread(open, tmp, 'ab' if action == 'append' else 'wb')
+			try:
+				async for chunk in r.content.iter_chunked(self.CHUNK_SIZE):
+					await asyncio.to_thread(fd.write, chunk)
+				await asyncio.to_thread(syncFile, fd)
+			finally:
+				await asyncio.to_thread(fd.close)
+		except aiohttp.ClientError as e:
+			if self.verbose >= 2: print ("Download interrupted:", filename, e)
+			return False
+		finally:
+			r.release()
+		await asyncio.to_thread(os.replace, tmp, filename)
+		return filename
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the dropscan.py command line modes against the local mock server
+(dropscan_mock.py). Reports wall time, number of requests and bytes transferred
+for each mode, number of mailings and size of the local archive.
+With --startup, measures the startup time of offline commands instead.
+Usage: dropscan_bench.py --sizes 100,1000 --archive 0,0.5 --modes sync,check
+       dropscan_bench.py --startup 20
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import dropscan_mock
+
+SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'dropscan.py')
+MODES = {
+	'sync':          lambda n: ['-s', '--full', '--count', str(n), '-r'],
+	'check':         lambda n: ['-c', '-r'],
+	'forward_dir':   lambda n: ['-s', '--full', '--count', str(n), '-r', '--forward_dir', 'forward'],
+	'forward_older': lambda n: ['-s', '--full', '--count', str(n), '-r', '--forward_older', '30'],
+}
+# Commands without network access, for --startup
+STARTUP = {
+	'import':        ['-c', 'import dropscan'],
+	'help':          [SCRIPT, '--help'],
+	'check':         [SCRIPT, '-c', '--count', '1'],
+	'db-query':      [SCRIPT, '--db-query', 'none'],
+}
+
+
+def prepareArchive(folder, mock, fraction):
+	"""
+	Create local files for the given fraction of mailings, spread over yearly
+	subfolders like a grown archive, plus a forward folder with some scanned mailings
+	"""
+	os.makedirs(os.path.join(folder, 'forward'))
+	n = int(len(mock.mailings) * fraction)
+	for m in mock.mailings[:n]:
+		year = m['created_at'][:4]
+		os.makedirs(os.path.join(folder, year), exist_ok=True)
+		name = '%s_%s.pdf' % (m['created_at'][:10], m['barcode'])
+		with open(os.path.join(folder, year, name), 'wb') as f:
+			f.write(b'%PDF-1.4\n')
+	scanned = [ m for m in mock.mailings if m['status'] == 'scanned' ][:10]
+	for m in scanned:
+		name = '%s_%s_envelope.jpg' % (m['created_at'][:10], m['barcode'])
+		with open(os.path.join(folder, 'forward', name), 'wb') as f:
+			f.write(b'\xff\xd8\xff\xd9')
+
+
+def runScenario(mode, size, fraction, args):
+	"""
+	Run one dropscan.py mode in a fresh folder against a fresh mock server
+	Returns dict with the results
+	"""
+	mock = dropscan_mock.MockDropscan(size, args.pdf_size, args.jpg_size, args.latency)
+	(server, url) = dropscan_mock.startServer(mock)
+	folder = tempfile.mkdtemp(prefix='dropscan-bench-')
+	try:
+		prepareArchive(folder, mock, fraction)
+		cmd = [sys.executable, SCRIPT, '-u', 'bench', '-p', 'bench', '--base-url', url,
+			'--session-cache', os.path.join(folder, '.session.json')] + MODES[mode](size) + args.extra
+		mock.resetStats()
+		start = time.monotonic()
+		run = subprocess.run(cmd, cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+		wall = time.monotonic() - start
+		if run.returncode != 0:
+			print (run.stderr.decode(), file=sys.stderr)
+		return { 'mode': mode, 'mailings': size, 'archive': fraction, 'wall': round(wall, 3),
+			'requests': mock.stats['requests'], 'bytes': mock.stats['bytes'],
+			'endpoints': mock.stats['endpoints'], 'exit': run.returncode }
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(folder)
+
+
+def runStartup(name, runs):
+	"""
+	Run one offline command runs times in a fresh folder
+	Returns dict with the minimum and median wall time
+	"""
+	folder = tempfile.mkdtemp(prefix='dropscan-bench-')
+	env = dict(os.environ, PYTHONPATH=os.path.dirname(SCRIPT))
+	try:
+		times = []
+		for i in range(runs):
+			start = time.monotonic()
+			run = subprocess.run([sys.executable] + STARTUP[name], cwd=folder, env=env,
+				stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+			times.append(time.monotonic() - start)
+			if run.returncode != 0:
+				print (run.stderr.decode(), file=sys.stderr)
+		times.sort()
+		return { 'mode': 'startup:' + name, 'runs': runs, 'min': round(times[0], 4),
+			'median': round(times[len(times) // 2], 4), 'exit': run.returncode }
+	finally:
+		shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sizes', default='100,1000,10000', help='Numbers of mailings (default 100,1000,10000)')
+	parser.add_argument('--archive', default='0,0.5,1', help='Fractions of mailings already in the local archive (default 0,0.5,1)')
+	parser.add_argument('--modes', default=','.join(MODES), help='Modes to run (default: all of %s)' % (','.join(MODES)))
+	parser.add_argument('--pdf-size', type=int, default=50000, help='Size of each PDF in bytes')
+	parser.add_argument('--jpg-size', type=int, default=20000, help='Size of each envelope in bytes')
+	parser.add_argument('--latency', type=float, default=0, help='Delay of each response in seconds')
+	parser.add_argument('--startup', type=int, metavar='RUNS', help='Measure the startup time of offline commands (%s) over RUNS runs, instead of the modes' % (','.join(STARTUP)))
+	parser.add_argument('--json', help='Write results to this file')
+	parser.add_argument('extra', nargs='*', help='Additional arguments for dropscan.py (after --)')
+	args = parser.parse_args()
+
+	results = []
+	if args.startup:
+		print ("%-18s %6s %9s %10s" % ('command', 'runs', 'min [s]', 'median [s]'))
+		for name in STARTUP:
+			r = runStartup(name, args.startup)
+			results.append(r)
+			print ("%-18s %6d %9.4f %10.4f%s" % (r['mode'], r['runs'], r['min'], r['median'],
+				'' if r['exit'] == 0 else '  (exit %d)' % (r['exit'])))
+	else:
+		print ("%-14s %8s %8s %9s %9s %12s" % ('mode', 'mailings', 'archive', 'wall [s]', 'requests', 'bytes'))
+		for size in [ int(s) for s in args.sizes.split(',') ]:
+			for fraction in [ float(a) for a in args.archive.split(',') ]:
+				for mode in args.modes.split(','):
+					r = runScenario(mode, size, fraction, args)
+					results.append(r)
+					print ("%-14s %8d %8.2f %9.3f %9d %12d%s" % (r['mode'], r['mailings'], r['archive'],
+						r['wall'], r['requests'], r['bytes'], '' if r['exit'] == 0 else '  (exit %d)' % (r['exit'])))
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=2)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for secure.dropscan.de, for benchmarks and tests.
+Serves the endpoints used by the Dropscan class with N synthetic mailings:
+/login (CSRF meta tag), /services/scanboxes, /services/mailings (status filter,
+paging, ETag), /services/mailings/<id>/pdf, /services/mailings/zip (bulk download),
+envelope images, forwarding batches
+and request_forward. Request counts and bytes are available at /_stats.
+Usage: dropscan_mock.py -n 1000 --port 8080
+       dropscan.py -u mock -p mock --base-url http://127.0.0.1:8080 -s
+"""
+
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import re
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+import random
+import io
+import zipfile
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
+
+
+def makeJpeg(width, height, size):
+	"""
+	Synthetic baseline JPEG with valid JFIF/SOF headers, padded with comments to about size bytes.
+	The image data is only decodable if Pillow is installed (needed for thumb creation);
+	otherwise it is enough for filenames, combining and transfer tests.
+	"""
+	if Image is not None:
+		buf = io.BytesIO()
+		Image.new('RGB', (width, height), (230, 225, 210)).save(buf, 'JPEG')
+		img = buf.getvalue()
+		out = img[:2]
+		while len(out) + len(img) - 2 < size - 4:
+			n = min(65533, size - len(out) - len(img) - 4)
+			out += b'\xff\xfe' + struct.pack('>H', n + 2) + b'x' * n
+		return out + img[2:]
+	out = b'\xff\xd8'
+	out += b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x01' + struct.pack('>HH', 150, 150) + b'\x00\x00'
+	out += b'\xff\xc0' + struct.pack('>HBHHB', 17, 8, height, width, 3) + b'\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+	while len(out) < size - 2:
+		n = min(65533, size - 2 - len(out) - 4)
+		if n <= 0: break
+		out += b'\xff\xfe' + struct.pack('>H', n + 2) + b'x' * n
+	return out + b'\xff\xd9'
+
+
+def makePdf(pages, size):
+	"""
+	Valid PDF with the given number of empty pages, padded to about size bytes
+	"""
+	kids = ' '.join([ '%d 0 R' % (3 + i) for i in range(pages) ])
+	objs = [ b'<< /Type /Catalog /Pages 2 0 R >>',
+		('<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, pages)).encode() ]
+	for i in range(pages):
+		objs.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>')
+	pad = max(0, size - 200 - 80 * pages)
+	objs.append(('<< /Length %d >>\nstream\n' % (pad)).encode() + b'%' * pad + b'\nendstream')
+	out = b'%PDF-1.4\n'
+	offsets = []
+	for (i, o) in enumerate(objs):
+		offsets.append(len(out))
+		out += ('%d 0 obj\n' % (i + 1)).encode() + o + b'\nendobj\n'
+	xref = len(out)
+	out += ('xref\n0 %d\n0000000000 65535 f \n' % (len(objs) + 1)).encode()
+	for off in offsets:
+		out += ('%010d 00000 n \n' % (off)).encode()
+	out += ('trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objs) + 1, xref)).encode()
+	return out
+
+
+class MockDropscan:
+	"""
+	State of the mock service: mailings, batches, sessions and statistics
+	"""
+	SCANBOX = '1834'
+	STATUSES = [ ('scanned', 0.4), ('received', 0.2), ('forwarded', 0.3), ('destroyed', 0.1) ]
+
+	RECIPIENTS = [ 'Max Mustermann', 'Erika Mustermann' ]
+
+	def __init__(self, count=100, pdf_size=50000, jpg_size=20000, latency=0.0, error_rate=0.0, seed=1, scanboxes=1):
+		self.pdf = makePdf(2, pdf_size)
+		self.jpg = makeJpeg(1600, 1100, jpg_size)
+		self.thumb = makeJpeg(320, 220, max(1000, jpg_size // 10))
+		self.latency = latency
+		self.error_rate = error_rate
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.sessions = set()
+		self.base_url = ''
+		self.scanboxes = [ { 'id': str(int(self.SCANBOX) + i), 'name': 'Box%d' % (i + 1),
+			'recipients': [ { 'name': r } for r in self.RECIPIENTS ] } for i in range(scanboxes) ]
+		self.mailings = []
+		now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+		for i in range(count):
+			r = self.random.random()
+			for (status, p) in self.STATUSES:
+				if r < p: break
+				r -= p
+			created = now - datetime.timedelta(hours=6 * i)
+			self.mailings.append({
+				'id': 'm%06d' % (i),
+				'barcode': 'BC%06d' % (i),
+				'status': status,
+				'scanbox_id': self.scanboxes[i % scanboxes]['id'],
+				'recipient': self.RECIPIENTS[0] if scanboxes == 1 else self.RECIPIENTS[i // scanboxes % 2],
+				'created_at': created.isoformat(),
+				'scanned_at': (created + datetime.timedelta(hours=2)).isoformat() if status != 'received' else None,
+				'forwarding_batch_id': None,
+			})
+		self.batches = [ { 'id': 'b1', 'mailings': [], 'requested_for': '2024-02-01', 'sent_at': None } ]
+		self.resetStats()
+
+	def resetStats(self):
+		with self.lock:
+			self.stats = { 'requests': 0, 'bytes': 0, 'endpoints': {} }
+
+	def count(self, endpoint, nbytes):
+		with self.lock:
+			self.stats['requests'] += 1
+			self.stats['bytes'] += nbytes
+			e = self.stats['endpoints'].setdefault(endpoint, { 'requests': 0, 'bytes': 0 })
+			e['requests'] += 1
+			e['bytes'] += nbytes
+
+	def mailingJSON(self, m):
+		d = dict(m)
+		d['envelope_url'] = self.base_url + '/envelopes/%s.jpg' % (m['id'])
+		d['envelope_thumbnail_url'] = self.base_url + '/envelopes/%s.small.jpg' % (m['id'])
+		return d
+
+	def listMailings(self, query):
+		statuses = query.get('statuses', [''])[0].split(',')
+		per_page = int(query.get('max_per_page', ['20'])[0])
+		page = int(query.get('page', ['0'])[0])
+		scanbox_ids = query.get('scanbox_ids', [self.SCANBOX])[0].split(',')
+		# forward_requested is listed as received, like at Dropscan
+		ms = [ m for m in self.mailings if m['scanbox_id'] in scanbox_ids and (m['status'] in statuses or
+			(m['status'] == 'forward_requested' and 'received' in statuses)) ]
+		sorting = query.get('sorting', ['created_at'])[0]
+		ms.sort(key=lambda m: m.get(sorting) or m['created_at'], reverse=query.get('sort_dir', ['desc'])[0] == 'desc')
+		return [ self.mailingJSON(m) for m in ms[page * per_page:(page + 1) * per_page] ]
+
+	def makeZip(self, ids):
+		"""
+		ZIP archive with <id>_envelope.jpg (stored) and <id>.pdf (deflated, scanned mailings only)
+		"""
+		buf = io.BytesIO()
+		with zipfile.ZipFile(buf, 'w') as z:
+			for id in ids:
+				m = self.findMailing(id)
+				if m is None:
+					continue
+				z.writestr('%s_envelope.jpg' % (id), self.jpg, zipfile.ZIP_STORED)
+				if m['scanned_at']:
+					z.writestr('%s.pdf' % (id), self.pdf, zipfile.ZIP_DEFLATED)
+		return buf.getvalue()
+
+	def findMailing(self, id):
+		for m in self.mailings:
+			if m['id'] == id:
+				return m
+		return None
+
+	def requestForward(self, id, batch_id):
+		with self.lock:
+			m = self.findMailing(id)
+			batch = [ b for b in self.batches if b['id'] == batch_id ]
+			if m is None or len(batch) == 0:
+				return False
+			batch[0]['mailings'].append(id)
+			m['forwarding_batch_id'] = batch_id
+			return True
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	mock = None
+
+	def setup(self):
+		super().setup()
+		# Headers and body are written separately; avoid delayed-ACK stalls on keep-alive connections
+		self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def log_message(self, format, *args):
+		pass
+
+	def send(self, status, body=b'', content_type='application/json', headers={}, endpoint=None):
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for (k, v) in headers.items():
+			self.send_header(k, v)
+		self.end_headers()
+		if self.command != 'HEAD':
+			self.wfile.write(body)
+		self.mock.count(endpoint or self.path.split('?')[0], len(body))
+
+	def sendJSON(self, data, endpoint):
+		body = json.dumps(data).encode()
+		etag = '"%s"' % (hashlib.sha1(body).hexdigest())
+		if self.headers.get('If-None-Match') == etag:
+			return self.send(304, headers={ 'ETag': etag }, endpoint=endpoint)
+		self.send(200, body, headers={ 'ETag': etag }, endpoint=endpoint)
+
+	def sendFile(self, data, content_type, endpoint):
+		"""
+		Send data, supporting single byte ranges ("Range: bytes=N-")
+		"""
+		rng = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+		if rng:
+			start = int(rng.group(1))
+			if start >= len(data):
+				return self.send(416, endpoint=endpoint)
+			return self.send(206, data[start:], content_type, {
+				'Content-Range': 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)) }, endpoint)
+		self.send(200, data, content_type, { 'Accept-Ranges': 'bytes' }, endpoint)
+
+	def loggedIn(self):
+		cookie = self.headers.get('Cookie', '')
+		m = re.search(r'_dropscan_session=([0-9a-f]+)', cookie)
+		return m is not None and m.group(1) in self.mock.sessions
+
+	def prepare(self):
+		"""
+		Simulated latency and server errors. Returns False if an error was sent.
+		"""
+		if self.mock.latency > 0:
+			time.sleep(self.mock.latency)
+		if self.mock.error_rate > 0 and not self.path.startswith('/_stats'):
+			with self.mock.lock:
+				fail = self.mock.random.random() < self.mock.error_rate
+			if fail:
+				self.send(503, b'{}', headers={ 'Retry-After': '0' }, endpoint='error')
+				return False
+		return True
+
+	def do_GET(self):
+		if not self.prepare(): return
+		url = urllib.parse.urlparse(self.path)
+		query = urllib.parse.parse_qs(url.query)
+		path = url.path
+		if path == '/_stats':
+			return self.send(200, json.dumps(self.mock.stats).encode(), endpoint='_stats')
+		if path == '/login':
+			html = '<html><head><meta name="csrf-token" content="mocktoken"></head><body>Login</body></html>'
+			return self.send(200, html.encode(), 'text/html', endpoint='login')
+		if re.match(r'^/scanboxes/\w+/mailings$', path):
+			return self.send(200, b'<html>Mailings</html>', 'text/html', endpoint='login')
+		if path.startswith('/envelopes/'):
+			if path.endswith('.small.jpg'):
+				return self.sendFile(self.mock.thumb, 'image/jpeg', 'thumb')
+			return self.sendFile(self.mock.jpg, 'image/jpeg', 'envelope')
+		if not self.loggedIn():
+			return self.send(401, b'{"error": "unauthorized"}', endpoint='unauthorized')
+		if path == '/services/scanboxes':
+			return self.sendJSON(self.mock.scanboxes, 'scanboxes')
+		if path == '/services/mailings':
+			return self.sendJSON(self.mock.listMailings(query), 'mailings')
+		m = re.match(r'^/services/mailings/(\w+)/pdf$', path)
+		if m:
+			if self.mock.findMailing(m.group(1)) is None:
+				return self.send(404, endpoint='pdf')
+			return self.sendFile(self.mock.pdf, 'application/pdf', 'pdf')
+		if path == '/services/mailings/zip':
+			ids = [ i for i in query.get('mailing_ids', [''])[0].split(',') if i ]
+			return self.sendFile(self.mock.makeZip(ids), 'application/zip', 'zip')
+		if path == '/services/forwarding_batches':
+			return self.sendJSON(self.mock.batches, 'forwarding_batches')
+		self.send(404, endpoint='404')
+
+	def do_POST(self):
+		if not self.prepare(): return
+		length = int(self.headers.get('Content-Length', 0))
+		body = self.rfile.read(length).decode()
+		path = urllib.parse.urlparse(self.path).path
+		if path == '/_stats/reset':
+			self.mock.resetStats()
+			return self.send(200, b'{}', endpoint='_stats')
+		if path == '/login':
+			form = urllib.parse.parse_qs(body)
+			if form.get('authenticity_token') != ['mocktoken']:
+				return self.send(200, b'<html>Login</html>', 'text/html', endpoint='login')
+			session = hashlib.sha1(str(random.random()).encode()).hexdigest()
+			self.mock.sessions.add(session)
+			return self.send(302, headers={ 'Location': '/scanboxes/%s/mailings' % (self.mock.SCANBOX),
+				'Set-Cookie': '_dropscan_session=%s; Path=/' % (session) }, endpoint='login')
+		if not self.loggedIn():
+			return self.send(401, b'{"error": "unauthorized"}', endpoint='unauthorized')
+		m = re.match(r'^/services/mailings/(\w+)/request_forward$', path)
+		if m:
+			batch_id = json.loads(body or '{}').get('forwarding_batch_id')
+			ok = self.mock.requestForward(m.group(1), batch_id)
+			return self.send(200 if ok else 422, b'{}', endpoint='request_forward')
+		self.send(404, endpoint='404')
+
+
+def startServer(mock, port=0):
+	"""
+	Start the mock server in a background thread. Returns (server, base_url).
+	"""
+	handler = type('Handler', (MockHandler,), { 'mock': mock })
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+	server.daemon_threads = True
+	mock.base_url = 'http://127.0.0.1:%d' % (server.server_address[1])
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return (server, mock.base_url)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', type=int, default=100, help='Number of mailings (default 100)')
+	parser.add_argument('--port', type=int, default=8080, help='Port (default 8080)')
+	parser.add_argument('--pdf-size', type=int, default=50000, help='Size of each PDF in bytes')
+	parser.add_argument('--jpg-size', type=int, default=20000, help='Size of each envelope in bytes')
+	parser.add_argument('--latency', type=float, default=0, help='Delay of each response in seconds')
+	parser.add_argument('--scanboxes', type=int, default=1, help='Number of scanboxes (default 1)')
+	parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with 503')
+	args = parser.parse_args()
+	mock = MockDropscan(args.n, args.pdf_size, args.jpg_size, args.latency, args.error_rate, scanboxes=args.scanboxes)
+	(server, url) = startServer(mock, args.port)
+	print ("Mock Dropscan with %d mailings at %s" % (args.n, url))
+	try:
+		while True: time.sleep(3600)
+	except KeyboardInterrupt:
+		server.shutdown()